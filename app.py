@@ -1,13 +1,24 @@
-from bs4 import BeautifulSoup
+from audit import apply_retention, audit_entries, audit_writer, audited_tables
+from auth_guard import PasswordHasher, RateLimiter, charge_failure, client_ip, form_username, rate_limited
+from assignments import apply_assignments, assigned_locations, assigned_product_ids, assignment_matrix, assignments_for
 from counter import global_counter, get_next_counter_value
 from datetime import datetime
 from decorators import role_required, user_details
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, send_file, make_response, g
+from bom import RecipeCycleError, benchmark_menu, flatten_dish, recipe_expander, set_dish_components
+from costing import dish_cost, dishes_for_products, menu_costs, price_history, recompute_dish_costs, set_product_prices
+from dispatch import OrderDispatcher, ORDERS_FOLDER, enqueue_order, parse_supplier_email, recent_orders, transport_from_config
+from exports import available_formats, benchmark_export, write_export
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, abort, send_file, make_response, g, jsonify
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from forms import LoginForm, RegistrationForm
+from http_cache import conditional_on, fingerprint_static_urls, optimise_response, seed_table_versions
 from io import BytesIO
+from live_count import LiveCountHub, count_lines
 from load_data_from_excel import load_data_from_excel
-from models import db, Product, Location, Measurement, add_default_measurements, Supplier, User, Dish, UserProductLocation, DishProduct
+from models import db, DishCost, InventorySnapshot, ProductPrice, OrderOutbox, Product, Location, Measurement, add_default_measurements, add_default_establishments, upgrade_schema, Supplier, SupplierProduct, User, Dish, DishProduct, DishComponent
+import asyncio
+import atexit
+import click
 import os
 import pandas as pd
 from reportlab.lib import colors
@@ -17,11 +28,17 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen import canvas
 from reportlab.platypus import Table, TableStyle
+from preparation import apply_preparation, backfill_preparation
 import qrcode
+from reports import compare_snapshots, record_snapshot, snapshot_list
+from supplier_catalogue import migrate_supplier_links, parse_catalogue_payload, product_choices, remove_product_links, supplier_links, sync_supplier_links
+from tenancy import bind_establishment, establishment_choices, establishment_names, location_choices, tenant_cache
 import tempfile
 from urllib.parse import quote
-from werkzeug.security import generate_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 from dotenv import load_dotenv
 
 app = Flask(__name__)
@@ -30,19 +47,108 @@ load_dotenv()
 app.secret_key = os.getenv('SECRET_KEY')
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Доставка заявок поставщикам: smtp, webhook или пусто (только генерация файла)
+app.config['ORDER_TRANSPORT'] = os.getenv('ORDER_TRANSPORT')
+app.config['ORDER_SMTP_HOST'] = os.getenv('ORDER_SMTP_HOST', 'localhost')
+app.config['ORDER_SMTP_PORT'] = os.getenv('ORDER_SMTP_PORT', '1025')
+app.config['ORDER_MAIL_SENDER'] = os.getenv('ORDER_MAIL_SENDER', 'orders@localhost')
+app.config['ORDER_WEBHOOK_URL'] = os.getenv('ORDER_WEBHOOK_URL')
+# ORDER_WORKER=1 — заявки отправляет отдельный процесс flask dispatch-orders
+app.config['ORDER_WORKER'] = bool(os.getenv('ORDER_WORKER'))
+# Сколько потоков общей инвентаризации (SSE) открыто одновременно: каждый занимает
+# обработчик запросов на всё время подключения, лимит должен быть меньше их числа
+app.config['LIVE_COUNT_MAX_STREAMS'] = int(os.getenv('LIVE_COUNT_MAX_STREAMS', 20))
+# Число обратных прокси перед приложением: адрес клиента для ограничения попыток
+# входа берётся из X-Forwarded-For. 0 — приложение доступно напрямую
+app.config['TRUSTED_PROXIES'] = int(os.getenv('TRUSTED_PROXIES', 0))
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
 db.init_app(app)
+audit_writer.init_app(app)
+atexit.register(audit_writer.stop)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
+app.before_request(bind_establishment)
+app.url_defaults(fingerprint_static_urls)
+app.after_request(optimise_response)
 pdfmetrics.registerFont(TTFont('DejaVuSans', 'DejaVuSans.ttf'))
 pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', 'DejaVuSans-Bold.ttf'))
 
 with app.app_context():
     db.create_all()
+    upgrade_schema()
+    add_default_establishments()
     add_default_measurements()
+    migrate_supplier_links()
+    seed_table_versions()
     #file_path = 'inv1.xlsx'
     #load_data_from_excel(file_path)
 
+order_dispatcher = OrderDispatcher(app, transport_from_config(app.config), autostart=not app.config['ORDER_WORKER'])
+# Заявки, оставшиеся в очереди или ждущие повтора после перезапуска, обрабатываются
+# сразу, а не только после следующей новой заявки
+if order_dispatcher.autostart:
+    order_dispatcher.start()
+live_count = LiveCountHub(app, max_streams=app.config['LIVE_COUNT_MAX_STREAMS'])
+
+# Вход: 10 попыток подряд с одного IP, дальше одна в 6 с; на одно имя — 5 неудачных
+# и дальше одна в 30 с (списываются после проверки пароля, см. login).
+# Регистрация: 5 с одного IP, дальше одна в минуту
+login_ip_limiter = RateLimiter(capacity=10, rate=1 / 6)
+login_username_limiter = RateLimiter(capacity=5, rate=1 / 30)
+register_ip_limiter = RateLimiter(capacity=5, rate=1 / 60)
+password_hasher = PasswordHasher()
+
+# Запуск обработчика очереди заявок отдельным процессом: flask --app app dispatch-orders
+# (вместе с ORDER_WORKER=1 у веб-приложения, чтобы оно не запускало свой поток)
+@app.cli.command('dispatch-orders')
+def dispatch_orders_command():
+    asyncio.run(order_dispatcher.run())
+
+# Очистка и разбор технологии приготовления для блюд, сохранённых до появления
+# preparation_html: flask --app app backfill-preparation [--force]
+@app.cli.command('backfill-preparation')
+@click.option('--force', is_flag=True, help='пересчитать все блюда')
+def backfill_preparation_command(force):
+    print(f'Обработано блюд: {backfill_preparation(force=force)}')
+
+# Политика хранения журнала изменений: flask --app app audit-retention --days 180
+@app.cli.command('audit-retention')
+@click.option('--days', default=180, show_default=True, help='сколько дней хранить записи в базе')
+@click.option('--archive', default=os.path.join('instance', 'audit_archive'), show_default=True, help='папка для помесячных архивов; пусто — без архива')
+def audit_retention_command(days, archive):
+    print(f'Удалено записей журнала: {apply_retention(days, archive or None)}')
+
+# Замер разворачивания всего меню до сырья: flask --app app benchmark-recipes
+@app.cli.command('benchmark-recipes')
+def benchmark_recipes_command():
+    dish_ids = db.session.scalars(db.select(Dish.id)).all()
+    timings = benchmark_menu(dish_ids)
+    print(f"Блюд: {len(dish_ids)}, строк сырья: {timings['products']}")
+    print(f"Без кэша: {timings['cold'] * 1000:.1f} мс, из кэша: {timings['warm'] * 1000:.2f} мс")
+
+# Выгрузка таблиц для BI: flask --app app export-data --output export.zip [--since 2024-10-01]
+@app.cli.command('export-data')
+@click.option('--output', required=True, help='путь к zip-архиву')
+@click.option('--since', type=click.DateTime(), default=None, help='только строки, изменённые с этого момента')
+@click.option('--establishment', type=int, default=None, help='id заведения; по умолчанию все')
+@click.option('--format', 'file_format', type=click.Choice(['parquet', 'arrow', 'csv']), default=None, help='по умолчанию лучший доступный')
+def export_data_command(output, since, establishment, file_format):
+    manifest = write_export(output, establishment_id=establishment, since=since, file_format=file_format)
+    print(f"Формат: {manifest['format']}, строк: {sum(table['rows'] for table in manifest['tables'].values())}")
+
+# Замер скорости выгрузки: flask --app app benchmark-export --rows 1000000
+@app.cli.command('benchmark-export')
+@click.option('--rows', default=1000000, show_default=True)
+@click.option('--format', 'file_format', type=click.Choice(['parquet', 'arrow', 'csv']), default=None)
+def benchmark_export_command(rows, file_format):
+    result = benchmark_export(rows, file_format)
+    print(f"Формат: {result['format']}, строк: {result['rows']}, {result['seconds']:.1f} с ({result['rows_per_second']:.0f} строк/с)")
+    print(f"Размер файла: {result['bytes'] / 1024 / 1024:.1f} МБ")
+    if result['peak_rss_growth_mb'] is not None:
+        print(f"Рост пиковой памяти: {result['peak_rss_growth_mb']:.0f} МБ")
+
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
@@ -72,7 +178,7 @@ def user_list():
             db.session.commit()
             return redirect(url_for('suppliers_page'))
     users = User.query.all()
-    establishments = {1: 'Лукашевича', 2: 'Ленина'}  
+    establishments = establishment_names()
     return render_template('user_list.html', users=users, establishments=establishments, establishment_name=g.establishment_name, role=g.role, username=g.username )
 
 @app.route('/set_role/<int:user_id>', methods=['POST'])
@@ -96,8 +202,10 @@ def set_role(user_id):
     return redirect(url_for('user_list'))  # Перенаправляем на список пользователей или другую страницу
 
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limited((register_ip_limiter, client_ip))
 def register():
     form = RegistrationForm()
+    form.establishment.choices = establishment_choices()
 
     # Проверим, проходит ли форма валидацию
     if form.validate_on_submit():
@@ -106,8 +214,8 @@ def register():
         role = form.role.data  # Получаем выбранную роль
         establishment_id = form.establishment.data
         
-        # Хешируем пароль
-        password_hash = generate_password_hash(password)
+        # Хешируем пароль в ограниченном пуле (см. auth_guard.py)
+        password_hash = password_hasher.hash(password)
         
         # Создаем нового пользователя
         new_user = User(username=username, password_hash=password_hash, role=role, establishment_id=establishment_id)
@@ -130,6 +238,7 @@ def register():
 
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limited((login_ip_limiter, client_ip))
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('products_page'))
@@ -137,11 +246,13 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user and user.check_password(form.password.data):
+        if user and password_hasher.verify(user.password_hash, form.password.data):
+            login_username_limiter.reset(form_username())
             login_user(user)
             flash('Вы успешно вошли в систему!')
             return redirect(url_for('products_page'))
         else:
+            charge_failure(login_username_limiter, form_username())
             flash('Неверное имя пользователя или пароль')
     return render_template('login.html', form=form)
 
@@ -159,6 +270,7 @@ def home_page():
 
 @app.route('/products', methods=['GET', 'POST'])
 @login_required
+@conditional_on('products', 'location', 'measurement')
 @user_details
 def products_page():
     locations = Location.query.filter_by(establishment_id=g.establishment_id).all()
@@ -173,6 +285,7 @@ def products_page():
             product = Product(name=product_name, location_id=location_id, measurement_id=measurement_id, establishment_id=g.establishment_id)
             db.session.add(product)
             db.session.commit()
+            tenant_cache.invalidate(g.establishment_id)
             return redirect(url_for('products_page'))
 
     products = Product.query.all()
@@ -188,37 +301,50 @@ def locations_page():
             location = Location(name=location_name, establishment_id=g.establishment_id)
             db.session.add(location)
             db.session.commit()
+            tenant_cache.invalidate(g.establishment_id)
             return redirect(url_for('locations_page'))
     locations = Location.query.filter_by(establishment_id=g.establishment_id).all()
     return render_template('locations.html', locations=locations, username=g.username, role=g.role, establishment_name=g.establishment_name)
 
 @app.route('/suppliers', methods=['GET', 'POST'])
 @login_required
+@conditional_on('suppliers', 'supplier_product', 'products', 'measurement')
 @user_details
 def suppliers_page():
+    error = None
     if request.method == 'POST':
         supplier_name = request.form.get('supplier')
         if supplier_name:
-            supplier = Supplier(name=supplier_name)
-            db.session.add(supplier)
-            db.session.commit()
-            return redirect(url_for('suppliers_page'))
+            try:
+                email = parse_supplier_email(request.form.get('email'))
+            except ValueError:
+                error = 'Некорректный email поставщика.'
+            else:
+                supplier = Supplier(name=supplier_name, email=email, establishment_id=g.establishment_id)
+                db.session.add(supplier)
+                try:
+                    db.session.commit()
+                    return redirect(url_for('suppliers_page'))
+                except IntegrityError:
+                    db.session.rollback()
+                    error = 'Поставщик с таким названием уже есть.'
 
-    suppliers = Supplier.query.all()
-    return render_template('suppliers.html', suppliers=suppliers, establishment_name=g.establishment_name,  username=g.username, role=g.role)
+    suppliers = Supplier.query.options(selectinload(Supplier.products).joinedload(Product.measurement)).all()
+    return render_template('suppliers.html', suppliers=suppliers, error=error, establishment_name=g.establishment_name,  username=g.username, role=g.role)
 
 @app.route('/products/<int:product_id>/edit', methods=['GET', 'POST'])
 @login_required
 @user_details
 def edit_product(product_id):
     product = Product.query.get_or_404(product_id)
-    locations = Location.query.all()
+    locations = location_choices()
     measurements = Measurement.query.all()
     if request.method == 'POST':
         product.name = request.form.get('product')
         product.location_id = request.form.get('location')
         product.measurement_id = request.form.get('measurement')
         db.session.commit()
+        tenant_cache.invalidate(g.establishment_id)
         return redirect(url_for('products_page'))
 
     return render_template('edit_product.html', product=product, locations=locations, measurements=measurements, establishment_name=g.establishment_name,  username=g.username, role=g.role)
@@ -239,22 +365,37 @@ def edit_location(location_id):
 @user_details
 def edit_supplier(supplier_id):
     supplier = Supplier.query.get_or_404(supplier_id)
-    products = Product.query.all()
     if request.method == 'POST':
-        product_ids = request.form.getlist('products')
-        supplier.products = Product.query.filter(Product.id.in_(product_ids)).all()
-        db.session.commit()
+        # Форма редактирует название и email; состав каталога меняется через supplier_catalogue
+        supplier_name = request.form.get('supplier')
+        if supplier_name:
+            try:
+                email = parse_supplier_email(request.form.get('email'))
+            except ValueError:
+                return render_template('edit_supplier.html', supplier=supplier, error='Некорректный email поставщика.', establishment_name=g.establishment_name, username=g.username, role=g.role)
+            supplier.name = supplier_name
+            supplier.email = email
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                return render_template('edit_supplier.html', supplier=supplier, error='Поставщик с таким названием уже есть.', establishment_name=g.establishment_name, username=g.username, role=g.role)
         return redirect(url_for('suppliers_page'))
 
-    return render_template('edit_supplier.html', supplier=supplier, products=products, establishment_name=g.establishment_name, username=g.username, role=g.role )
+    return render_template('edit_supplier.html', supplier=supplier, establishment_name=g.establishment_name, username=g.username, role=g.role )
 
 
 @app.route('/products/<int:product_id>/delete', methods=['POST'])
 @login_required
 def delete_product(product_id):
     product = Product.query.get_or_404(product_id)
+    affected_dishes = dishes_for_products([product.id])
+    remove_product_links(product.id)
+    ProductPrice.query.filter_by(product_id=product.id).delete()
     db.session.delete(product)
     db.session.commit()
+    tenant_cache.invalidate(product.establishment_id)
+    recompute_dish_costs(affected_dishes)
     return redirect(url_for('products_page'))
 
 @app.route('/locations/<int:location_id>/delete', methods=['POST'])
@@ -272,6 +413,7 @@ def delete_location(location_id):
 
     db.session.delete(location)
     db.session.commit()
+    tenant_cache.invalidate(location.establishment_id)
     return redirect(url_for('locations_page'))
 
 @app.route('/suppliers/<int:supplier_id>/delete', methods=['POST'])
@@ -279,7 +421,7 @@ def delete_location(location_id):
 def delete_supplier(supplier_id):
     supplier = Supplier.query.get_or_404(supplier_id)
 
-    products_using_supplier = Product.query.filter_by(supplier_id=supplier_id).all()
+    products_using_supplier = SupplierProduct.query.filter_by(supplier_id=supplier_id).first()
     
     if products_using_supplier:
         error_message = "Cannot delete this suppliar because it is used in one or more products."
@@ -294,12 +436,9 @@ def delete_supplier(supplier_id):
 @login_required
 def remove_product_from_supplier(supplier_id, product_id):
     supplier = Supplier.query.get(supplier_id)
-    product = Product.query.get(product_id)
 
-    if supplier and product:
-        # Удаление связи между поставщиком и продуктом
-        supplier.products.remove(product)
-        db.session.commit()
+    if supplier and sync_supplier_links(supplier.id, remove={product_id})['removed']:
+        # Связь между поставщиком и продуктом удалена
         flash('Продукт успешно удален из списка поставщика.', 'success')
     else:
         flash('Не удалось найти поставщика или продукт.', 'error')
@@ -307,40 +446,107 @@ def remove_product_from_supplier(supplier_id, product_id):
     # Возвращаемся на страницу поставщика
     return redirect(url_for('suppliers_page', supplier_id=supplier_id))
 
+# Количества из присланной инвентаризации: JSON {"items": [[product_id, количество], ...]}
+# только с введёнными позициями или обычная форма с полями quantity_<id>.
+# Разбор идёт по присланным значениям, а не по всему каталогу
+def _submitted_quantities():
+    try:
+        if request.is_json:
+            items = (request.get_json(silent=True) or {})['items']
+            if not isinstance(items, list):
+                abort(400)
+            return {int(product_id): None if quantity is None else float(quantity) for product_id, quantity in items}
+        return {
+            int(name[len('quantity_'):]): float(value)
+            for name, value in request.form.items()
+            if name.startswith('quantity_') and value
+        }
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
 @app.route('/inventory', methods=['GET', 'POST'])
 @login_required
 @user_details
 def inventory_page():
-    user_id = current_user.id
-    assigned_locations = UserProductLocation.query.filter_by(user_id=user_id).all()
-    
-    # Фильтруем уникальные локации и продукты
-    locations = {assignment.location for assignment in assigned_locations}
     current_date = datetime.now().strftime('%d.%m.%y')
 
     if request.method == 'POST':
-        data = []
-        for location in locations:
-            for product in location.products:
-                quantity = request.form.get(f'quantity_{product.id}')
-                if quantity:
-                    data.append({
-                        'Название': product.name,
-                        'Расположение': product.location.name,
-                        'Ед. изм.': product.measurement.name,
-                        'Колличество': float(quantity)
-                    })
+        quantities = _submitted_quantities()
+        if not quantities.keys() <= assigned_product_ids(current_user.id):
+            abort(403)
+        # Итог общей инвентаризации: количества всех поваров заведения плюс присланные
+        live_count.push(g.establishment_id, current_user.id, g.username, quantities)
+        snapshot_lines = count_lines(live_count.close(g.establishment_id))
+        data = [
+            {
+                'Название': line['product_name'],
+                'Расположение': line['location_name'],
+                'Ед. изм.': line['measurement'],
+                'Колличество': line['quantity'],
+            }
+            for line in snapshot_lines
+        ]
 
         df = pd.DataFrame(data)
         counter_value = get_next_counter_value()
+        # Сохраняем инвентаризацию в базе для отчётов (см. reports.py)
+        snapshot_id = record_snapshot(snapshot_lines, user_id=current_user.id, number=counter_value)
         file_name = f'Инвентаризация_{g.establishment_name}_{current_date}_№{counter_value}.xlsx'
         file_path = os.path.join('static', file_name)
         df.to_excel(file_path, index=False)
 
+        if request.is_json:
+            return jsonify({'snapshot_id': snapshot_id, 'download_url': url_for('download_file', file_name=file_name)})
         return redirect(url_for('download_file', file_name=file_name))
 
+    # Локации и продукты берутся одним запросом и кэшируются до изменения назначений
+    locations = assigned_locations(current_user.id)
     return render_template('inventory.html', locations=locations, current_date=current_date, establishment_name=g.establishment_name,  username=g.username, role=g.role)
 
+# Изменения общей инвентаризации от одного повара: {"quantities": {"12": 3.5, "13": null}}
+@app.route('/inventory/live', methods=['POST'])
+@login_required
+@user_details
+def inventory_live():
+    payload = request.get_json(silent=True) or {}
+    try:
+        quantities = {
+            int(product_id): None if quantity is None else float(quantity)
+            for product_id, quantity in payload['quantities'].items()
+        }
+    except (AttributeError, KeyError, TypeError, ValueError):
+        abort(400)
+    if not quantities.keys() <= assigned_product_ids(current_user.id):
+        abort(403)
+    seq = live_count.push(g.establishment_id, current_user.id, g.username, quantities)
+    return jsonify({'seq': seq})
+
+# Поток изменений общей инвентаризации (server-sent events)
+@app.route('/inventory/live/stream', methods=['GET'])
+@login_required
+def inventory_live_stream():
+    response = Response(live_count.open_stream(g.establishment_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Сравнение двух сохранённых инвентаризаций; по умолчанию — двух последних
+@app.route('/reports', methods=['GET'])
+@login_required
+@user_details
+def reports_page():
+    snapshots = snapshot_list()
+    current_id = request.args.get('current', type=int) or (snapshots[0].id if snapshots else None)
+    base_id = request.args.get('base', type=int) or (snapshots[1].id if len(snapshots) > 1 else current_id)
+
+    report = None
+    if current_id and base_id:
+        InventorySnapshot.query.get_or_404(current_id)
+        InventorySnapshot.query.get_or_404(base_id)
+        report = compare_snapshots(base_id, current_id)
+
+    return render_template('reports.html', snapshots=snapshots, base_id=base_id, current_id=current_id, report=report, establishment_name=g.establishment_name, username=g.username, role=g.role)
+
 @app.route('/download/<file_name>')
 @login_required
 def download_file(file_name):
@@ -357,10 +563,7 @@ def download_file(file_name):
 @user_details
 def download_order():
     supplier_id = request.form.get('supplier_id')
-    supplier = Supplier.query.get(supplier_id)
-    
-    # Получаем текущую дату в формате ДД.ММ
-    current_date = datetime.now().strftime('%d.%m')
+    supplier = Supplier.query.get_or_404(supplier_id)
 
     data = []
     for product in supplier.products:
@@ -373,17 +576,12 @@ def download_order():
             })
 
     if data:
-        counter_value = get_next_counter_value()
-        # Генерируем имя файла с датой
-        file_name = f'Заявка_{supplier.name}_{g.establishment_name}_{current_date}_№{counter_value}.xlsx'
-        file_path = os.path.join('static', file_name)
-
-        # Записываем данные в Excel
-        df = pd.DataFrame(data)
-        df.to_excel(file_path, index=False)
-
-        # Отправляем файл для загрузки
-        return send_file(file_path, as_attachment=True)
+        # Файл генерируется и отправляется поставщику в фоне (см. dispatch.py)
+        order_id = enqueue_order(
+            order_dispatcher, supplier, data, g.establishment_id, g.establishment_name,
+            user_id=current_user.id, file_format=request.form.get('format', 'xlsx'),
+        )
+        flash(f'Заявка №{order_id} поставлена в очередь на отправку', 'success')
 
     # Если данные не заполнены, перенаправляем на страницу обратно
     return redirect(url_for('supplier_page'))
@@ -392,25 +590,41 @@ def download_order():
 @login_required
 @user_details
 def supplier_page():
-    suppliers = Supplier.query.all()
+    suppliers = Supplier.query.options(selectinload(Supplier.products).joinedload(Product.measurement)).all()
     current_date = datetime.now().strftime('%d.%m')
-    return render_template('suppliers_orders.html', suppliers=suppliers, current_date=current_date, establishment_name=g.establishment_name, username=g.username, role=g.role)
+    orders = recent_orders()
+    return render_template('suppliers_orders.html', suppliers=suppliers, orders=orders, current_date=current_date, establishment_name=g.establishment_name, username=g.username, role=g.role)
+
+@app.route('/orders/<int:order_id>/file')
+@login_required
+def download_order_file(order_id):
+    order = OrderOutbox.query.get_or_404(order_id)
+    if order.file_name:
+        file_path = os.path.join(app.instance_path, ORDERS_FOLDER, order.file_name)
+        if os.path.exists(file_path):
+            return send_file(file_path, as_attachment=True, download_name=f"{order.payload['title']}.{order.file_format}")
+    flash('Файл заявки ещё не готов', 'error')
+    return redirect(url_for('supplier_page'))
 
 @app.route('/suppliers/<int:supplier_id>/add_product', methods=['GET', 'POST'])
 @login_required
 @user_details
 def add_product_to_supplier(supplier_id):
     supplier = Supplier.query.get_or_404(supplier_id)
-    products = Product.query.group_by(Product.name).all()
+    products = product_choices()
     measurements = Measurement.query.all()
     if request.method == 'POST':
         product_id = request.form.get('product')
         measurement_id = request.form.get('measurement')
 
         if product_id and measurement_id:
-            product = Product.query.get_or_404(product_id)
-            supplier.products.append(product)  # Добавляем продукт к поставщику
-            db.session.commit()
+            # Добавляем продукт к поставщику вместе с ценой и фасовкой
+            links, _, _ = parse_catalogue_payload({'links': [{
+                'product_id': product_id,
+                'price': request.form.get('price'),
+                'pack_size': request.form.get('pack_size'),
+            }]})
+            sync_supplier_links(supplier.id, links)
             return redirect(url_for('suppliers_page'))  # Перенаправляем на страницу поставщиков
 
     return render_template('add_product_to_supplier.html', supplier=supplier, products=products, measurements=measurements, establishment_name=g.establishment_name, username=g.username, role=g.role)
@@ -419,30 +633,60 @@ def add_product_to_supplier(supplier_id):
 @login_required
 @user_details
 def edit_product_to_supplier(supplier_id):
-    product = Product.query.get_or_404(supplier_id)
     supplier = Supplier.query.get_or_404(supplier_id)
-    products = Product.query.group_by(Product.name).all()
+    # Редактируемый продукт передаётся как ?product_id=...
+    product = Product.query.get(request.args.get('product_id', type=int) or 0)
+    products = product_choices()
     measurements = Measurement.query.all()
-    product_ids = request.form.getlist('products')
-    supplier.products = Product.query.filter(Product.id.in_(product_ids)).all()
+    links = supplier_links(supplier.id)
+    link = links.get(product.id, (None, None)) if product else (None, None)
 
     if request.method == 'POST':
         product_id = request.form.get('product')
         measurement_id = request.form.get('measurement')
-        
 
         if product_id and measurement_id:
-            product = Product.query.get_or_404(product_id)
-            supplier.products.append(product)  # Добавляем продукт к поставщику
-            db.session.commit()
+            new_links, _, _ = parse_catalogue_payload({'links': [{
+                'product_id': product_id,
+                'price': request.form.get('price'),
+                'pack_size': request.form.get('pack_size'),
+            }]})
+            # Если выбран другой продукт, старая связь заменяется новой
+            remove = {product.id} - set(new_links) if product else set()
+            sync_supplier_links(supplier.id, new_links, remove=remove)
             return redirect(url_for('suppliers_page'))  # Перенаправляем на страницу поставщиков
 
-    return render_template('edit_product_to_supplier.html',product=product, supplier=supplier, products=products, measurements=measurements, establishment_name=g.establishment_name, username=g.username, role=g.role)
+    return render_template('edit_product_to_supplier.html', selected_product=product, link=link, supplier=supplier, products=products, measurements=measurements, establishment_name=g.establishment_name, username=g.username, role=g.role)
+
+# JSON API каталога поставщика: чтение и пакетное изменение сотен связей за один вызов
+@app.route('/suppliers/<int:supplier_id>/catalogue', methods=['GET', 'POST'])
+@login_required
+@user_details
+def supplier_catalogue(supplier_id):
+    supplier = Supplier.query.get_or_404(supplier_id)
+    if request.method == 'POST':
+        payload = request.get_json(silent=True)
+        if payload is None:
+            abort(400)
+        try:
+            links, remove, replace = parse_catalogue_payload(payload)
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+        return jsonify(sync_supplier_links(supplier.id, links, remove=remove, replace=replace))
+
+    return jsonify({
+        'supplier_id': supplier.id,
+        'links': [
+            {'product_id': product_id, 'price': price, 'pack_size': pack_size}
+            for product_id, (price, pack_size) in sorted(supplier_links(supplier.id).items())
+        ],
+    })
 
 
 # Главная страница со списком блюд
 @app.route('/dishes', methods=['GET'])
 @login_required
+@conditional_on('dishes')
 @user_details
 def dishes():
     dishes = Dish.query.all()
@@ -452,7 +696,78 @@ def dishes():
 @login_required
 def dish_detail(dish_id):
     dish = Dish.query.get_or_404(dish_id)
-    return render_template('dish_detail.html', dish=dish)
+    return render_template('dish_detail.html', dish=dish, cost=dish_cost(dish.id), raw_products=_raw_products(dish.id))
+
+# Сырьё блюда с учётом полуфабрикатов: [(product, количество)] по алфавиту
+def _raw_products(dish_id):
+    flat = flatten_dish(dish_id)
+    products = Product.query.options(joinedload(Product.measurement)).filter(Product.id.in_(flat)).order_by(Product.name).all()
+    return [(product, flat[product.id]) for product in products]
+
+# Полуфабрикаты блюда и его развёрнутый до сырья состав.
+# POST заменяет полуфабрикаты: {"components": [{"dish_id": 3, "quantity": 0.2}]}
+@app.route('/dishes/<int:dish_id>/components', methods=['GET', 'POST'])
+@login_required
+def dish_components(dish_id):
+    dish = Dish.query.get_or_404(dish_id)
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        try:
+            components = {int(line['dish_id']): float(line['quantity']) for line in payload['components']}
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+        if Dish.query.filter(Dish.id.in_(components)).count() != len(components):
+            abort(400)
+        try:
+            set_dish_components(dish.id, components)
+        except RecipeCycleError as e:
+            return jsonify({'error': str(e), 'cycle': e.cycle}), 409
+        recompute_dish_costs([dish.id])
+
+    return jsonify({
+        'dish_id': dish.id,
+        'components': [
+            {'dish_id': component.component_id, 'quantity': component.quantity}
+            for component in DishComponent.query.filter_by(dish_id=dish.id).order_by(DishComponent.component_id)
+        ],
+        'products': [
+            {'product_id': product_id, 'quantity': quantity}
+            for product_id, quantity in sorted(flatten_dish(dish.id).items())
+        ],
+    })
+
+# Себестоимость всех блюд меню из предрассчитанных агрегатов
+@app.route('/dishes/costs', methods=['GET'])
+@login_required
+def dishes_costs():
+    return jsonify([
+        {'dish_id': dish_id, 'name': name, 'cost': round(cost, 2), 'priced_lines': priced_lines, 'missing_lines': missing_lines}
+        for dish_id, name, cost, priced_lines, missing_lines in menu_costs()
+    ])
+
+# История цен продукта и добавление новой цены:
+# {"unit_price": 120.0, "supplier_id": 1, "effective_from": "2024-12-01"}
+@app.route('/products/<int:product_id>/prices', methods=['GET', 'POST'])
+@login_required
+def product_prices(product_id):
+    product = Product.query.get_or_404(product_id)
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        try:
+            effective_from = payload.get('effective_from')
+            set_product_prices([{
+                'product_id': product.id,
+                'supplier_id': payload.get('supplier_id'),
+                'unit_price': float(payload['unit_price']),
+                'effective_from': datetime.strptime(effective_from, '%Y-%m-%d').date() if effective_from else None,
+            }])
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+
+    return jsonify([
+        {'supplier_id': supplier_id, 'unit_price': unit_price, 'effective_from': effective_from.isoformat()}
+        for supplier_id, unit_price, effective_from in price_history(product.id)
+    ])
 
 @app.route('/dishes/<int:dish_id>/download', methods=['GET'])
 @login_required
@@ -486,15 +801,12 @@ def download_dish_pdf(dish_id):
 
  
 
-    # Парсинг HTML
-    soup = BeautifulSoup(dish.preparation_steps, "html.parser")
-    ol_items = soup.find_all('li')
-
+    # Шаги разобраны при сохранении блюда (preparation_step_list)
     y_position = 480
     pdf.setFont("DejaVuSans", 10)
 
-    for idx, li in enumerate(ol_items, start=1):
-        line = f"{idx}. {li.get_text(strip=True)}"
+    for idx, step in enumerate(dish.preparation_step_list or [], start=1):
+        line = f"{idx}. {step}"
         
         # Разбиваем текст на строки, чтобы он не выходил за правую границу
         wrapped_lines = simpleSplit(line, "DejaVuSans", 10, page_width - left_margin - right_margin)
@@ -519,13 +831,12 @@ def download_dish_pdf(dish_id):
 
     data = [["Название продукта", "Ед. изм.", "Вес"]]  # Заголовки
     pdf.setFont("DejaVuSans", 12)
-    # Добавляем данные о продуктах
-    for dish_product in dish.dish_products:
-        product = dish_product.product
+    # Добавляем данные о продуктах (полуфабрикаты развёрнуты до сырья)
+    for product, quantity in _raw_products(dish.id):
         data.append([
             product.name,
             product.measurement.name,
-            f"{dish_product.quantity:.2f}"
+            f"{quantity:.2f}"
         ])
     pdf.setFont("DejaVuSans", 12)
     # Настраиваем стиль таблицы
@@ -594,6 +905,7 @@ def add_dish():
         image_file = request.files.get('image')
         # Поле для изображения
         image_path = None
+        relative_image_path = None
         if image_file:
             filename = secure_filename(image_file.filename)
             relative_image_path = f"uploads/{filename}"
@@ -616,8 +928,9 @@ def add_dish():
             name=name,
             image_url=relative_image_path,
             video_url=relative_video_path,
-            preparation_steps=preparation_steps
+            establishment_id=g.establishment_id
         )
+        apply_preparation(dish, preparation_steps)
         db.session.add(dish)
         db.session.flush()  # Получаем ID блюда после вставки
 
@@ -642,20 +955,41 @@ def add_dish():
                     # Игнорируем, если количество не удалось преобразовать в float
                     continue
 
+        # Полуфабрикаты: новое блюдо ещё ни во что не входит, поэтому цикл невозможен
+        component_ids = request.form.getlist('component_id')
+        component_quantities = request.form.getlist('component_quantity')
+        components = {}
+        for component_id, quantity in zip(component_ids, component_quantities):
+            try:
+                components[int(component_id)] = float(quantity)
+            except ValueError:
+                continue
+        for component in Dish.query.filter(Dish.id.in_(components)):
+            db.session.add(DishComponent(dish_id=dish.id, component_id=component.id, quantity=components[component.id]))
+
         db.session.commit()  # Сохраняем все изменения в базе данных
+        recipe_expander.invalidate([dish.id])
+        recompute_dish_costs([dish.id])
         return redirect(url_for('dishes'))
     
-    return render_template('add_dish.html', products=products, measurements=measurements, establishment_name=g.establishment_name, username=g.username, role=g.role)
+    return render_template('add_dish.html', products=products, dishes=Dish.query.order_by(Dish.name).all(), measurements=measurements, establishment_name=g.establishment_name, username=g.username, role=g.role)
 
 @app.route('/dishes/<int:dish_id>/delete', methods=['POST'])
 @login_required
 def delete_dish(dish_id):
     dish = Dish.query.get_or_404(dish_id)
+    # Полуфабрикат нельзя удалить, пока он входит в другие блюда
+    if DishComponent.query.filter_by(component_id=dish.id).first():
+        flash('Блюдо используется как полуфабрикат в других блюдах', 'error')
+        return redirect(url_for('dishes'))
     # Удаляем связанные записи
     DishProduct.query.filter_by(dish_id=dish.id).delete()
+    DishComponent.query.filter_by(dish_id=dish.id).delete()
+    DishCost.query.filter_by(dish_id=dish.id).delete()
     # Удаляем сам объект Dish
     db.session.delete(dish)
     db.session.commit()
+    recipe_expander.invalidate([dish.id])
     return redirect(url_for('dishes'))
 
 @app.route('/profile', methods=['GET', 'POST'])
@@ -671,26 +1005,91 @@ def assign_inventory(user_id):
     user = User.query.get_or_404(user_id)
     
     # Получаем список локаций и продуктов для текущего заведения пользователя
-    locations = Location.query.filter_by(establishment_id=g.establishment_id).all()
+    locations = location_choices()
     
     
     if request.method == 'POST':
-        # Получаем выбранные продукты и локации из формы
-        
-        selected_locations = request.form.getlist('locations')
-        
-        # Удаляем текущие назначения и добавляем новые
-        UserProductLocation.query.filter_by(user_id=user.id).delete()
-        for location_id in selected_locations:
-            
-            assignment = UserProductLocation(user_id=user.id, location_id=location_id)
-            db.session.add(assignment)
-        
-        db.session.commit()
+        # Получаем выбранные локации из формы
+        selected_locations = {int(location_id) for location_id in request.form.getlist('locations')}
+
+        # Применяем только разницу между текущими и выбранными назначениями
+        apply_assignments({user.id: selected_locations})
         flash('Назначения успешно обновлены', 'success')
         return redirect(url_for('products_page'))  # Перенаправляем на панель администратора
 
-    return render_template('assign_inventory.html', user=user, locations=locations, username=g.username, role=g.role, establishment_name=g.establishment_name)
+    assigned_ids = assignments_for([user.id])[user.id]
+    return render_template('assign_inventory.html', user=user, locations=locations, assigned_ids=assigned_ids, username=g.username, role=g.role, establishment_name=g.establishment_name)
+
+# Выгрузка таблиц заведения zip-архивом (Parquet, Arrow IPC или CSV.gz);
+# ?since=2024-10-01T00:00 — только изменения, ?format=csv — конкретный формат
+@app.route('/export', methods=['GET'])
+@login_required
+@user_details
+@role_required('admin')
+def export_data():
+    file_format = request.args.get('format') or None
+    if file_format and file_format not in available_formats():
+        abort(400)
+    try:
+        since = datetime.fromisoformat(request.args['since']) if request.args.get('since') else None
+    except ValueError:
+        abort(400)
+    archive = tempfile.TemporaryFile()
+    write_export(archive, establishment_id=g.establishment_id, since=since, file_format=file_format)
+    archive.seek(0)
+    download_name = f"export_{g.establishment_name}_{datetime.now().strftime('%Y%m%d_%H%M')}.zip"
+    return send_file(archive, mimetype='application/zip', as_attachment=True, download_name=download_name)
+
+# Журнал изменений с фильтрами; следующая страница — ?before=<id>
+@app.route('/audit', methods=['GET'])
+@login_required
+@user_details
+@role_required('admin')
+def audit_page():
+    filters = {column: request.args.get(column, '').strip() for column in ('table_name', 'action', 'row_id', 'username')}
+    for column in ('date_from', 'date_to'):
+        value = request.args.get(column)
+        try:
+            filters[column] = datetime.strptime(value, '%Y-%m-%d') if value else None
+        except ValueError:
+            abort(400)
+    entries, next_before = audit_entries(filters, before_id=request.args.get('before', type=int))
+    query = {key: value for key, value in request.args.items() if key != 'before' and value}
+    return render_template('audit.html', entries=entries, next_before=next_before, query=query, filters=request.args, tables=audited_tables(), establishment_name=g.establishment_name, username=g.username, role=g.role)
+
+# Массовое редактирование назначений: все пользователи × все локации заведения за один запрос
+@app.route('/assign_inventory/matrix', methods=['GET', 'POST'])
+@login_required
+@user_details
+@role_required('admin')
+def assign_inventory_matrix():
+    users, locations, assigned = assignment_matrix()
+
+    if request.method == 'POST':
+        try:
+            if request.is_json:
+                # {"assignments": {"<user_id>": [<location_id>, ...]}} — меняются только перечисленные пользователи
+                payload = (request.get_json(silent=True) or {}).get('assignments', {})
+                if not isinstance(payload, dict) or not all(isinstance(location_ids, list) for location_ids in payload.values()):
+                    abort(400)
+                desired = {int(user_id): {int(location_id) for location_id in location_ids} for user_id, location_ids in payload.items()}
+            else:
+                # Чекбоксы формы имеют значения вида "<user_id>:<location_id>"
+                desired = {user.id: set() for user in users}
+                for value in request.form.getlist('assignment'):
+                    user_id, location_id = (int(part) for part in value.split(':'))
+                    if user_id in desired:
+                        desired[user_id].add(location_id)
+        except (AttributeError, TypeError, ValueError):
+            abort(400)
+
+        added, removed = apply_assignments(desired)
+        if request.is_json:
+            return jsonify({'added': added, 'removed': removed})
+        flash(f'Назначения обновлены: добавлено {added}, удалено {removed}', 'success')
+        return redirect(url_for('assign_inventory_matrix'))
+
+    return render_template('assign_inventory_matrix.html', users=users, locations=locations, assigned=assigned, username=g.username, role=g.role, establishment_name=g.establishment_name)
 
 @app.route('/assign_inventory', methods=['GET', 'POST'])
 @login_required
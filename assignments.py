@@ -0,0 +1,114 @@
+from collections import namedtuple
+from sqlalchemy import delete, select, tuple_
+from models import db, insert_ignoring_duplicates, Location, Measurement, Product, User, UserProductLocation
+from tenancy import current_establishment_id, location_choices, tenant_cache
+
+AssignedLocation = namedtuple('AssignedLocation', ['id', 'name', 'products'])
+AssignedProduct = namedtuple('AssignedProduct', ['id', 'name', 'measurement'])
+
+
+def _cache_key(user_id):
+    return ('assigned_locations', user_id)
+
+
+def _ids_cache_key(user_id):
+    return ('assigned_product_ids', user_id)
+
+
+# Текущие назначения одним запросом: {user_id: {location_id, ...}}
+def assignments_for(user_ids):
+    assignments = {user_id: set() for user_id in user_ids}
+    rows = db.session.execute(
+        select(UserProductLocation.user_id, UserProductLocation.location_id)
+        .where(UserProductLocation.user_id.in_(assignments))
+    )
+    for user_id, location_id in rows:
+        assignments[user_id].add(location_id)
+    return assignments
+
+
+# Приводит назначения к желаемому состоянию {user_id: {location_id, ...}}:
+# удаляются и добавляются только отличающиеся пары, всё в одной транзакции
+def apply_assignments(desired, establishment_id=None):
+    establishment_id = establishment_id or current_establishment_id()
+    allowed_locations = {location.id for location in location_choices(establishment_id)}
+    allowed_users = set(db.session.scalars(
+        select(User.id).where(User.id.in_(desired), User.establishment_id == establishment_id)
+    ))
+    desired = {
+        user_id: set(location_ids) & allowed_locations
+        for user_id, location_ids in desired.items() if user_id in allowed_users
+    }
+
+    to_insert, to_delete = [], []
+    for user_id, existing in assignments_for(desired).items():
+        to_insert.extend({'user_id': user_id, 'location_id': location_id} for location_id in desired[user_id] - existing)
+        to_delete.extend((user_id, location_id) for location_id in existing - desired[user_id])
+
+    if to_delete:
+        db.session.execute(
+            delete(UserProductLocation)
+            .where(tuple_(UserProductLocation.user_id, UserProductLocation.location_id).in_(to_delete))
+            .execution_options(synchronize_session=False)
+        )
+    if to_insert:
+        # Если другой администратор уже добавил ту же пару, вставка просто пропускается
+        db.session.execute(insert_ignoring_duplicates(UserProductLocation.__table__), to_insert)
+    db.session.commit()
+
+    # Сбрасываем кэш только тех пользователей, у которых что-то изменилось
+    for user_id in {row['user_id'] for row in to_insert} | {user_id for user_id, _ in to_delete}:
+        tenant_cache.invalidate(establishment_id, _cache_key(user_id))
+        tenant_cache.invalidate(establishment_id, _ids_cache_key(user_id))
+    return len(to_insert), len(to_delete)
+
+
+def _load_assigned_locations(user_id):
+    rows = db.session.execute(
+        select(Location.id, Location.name, Product.id, Product.name, Measurement.name)
+        .join(UserProductLocation, UserProductLocation.location_id == Location.id)
+        .outerjoin(Product, Product.location_id == Location.id)
+        .outerjoin(Measurement, Measurement.id == Product.measurement_id)
+        .where(UserProductLocation.user_id == user_id)
+        .order_by(Location.id, Product.id)
+    )
+    locations = {}
+    for location_id, location_name, product_id, product_name, measurement_name in rows:
+        location = locations.setdefault(location_id, AssignedLocation(location_id, location_name, []))
+        if product_id is not None:
+            location.products.append(AssignedProduct(product_id, product_name, measurement_name))
+    return list(locations.values())
+
+
+# Назначенные пользователю локации вместе с продуктами; кэшируется до изменения назначений
+# или продуктов заведения
+def assigned_locations(user_id, establishment_id=None):
+    establishment_id = establishment_id or current_establishment_id()
+    return tenant_cache.get_or_set(establishment_id, _cache_key(user_id), lambda: _load_assigned_locations(user_id))
+
+
+# Индекс продуктов, которые пользователь может считать: проверка присланной
+# инвентаризации — одно сравнение множеств. Сбрасывается вместе с assigned_locations
+def assigned_product_ids(user_id, establishment_id=None):
+    establishment_id = establishment_id or current_establishment_id()
+    return tenant_cache.get_or_set(establishment_id, _ids_cache_key(user_id), lambda: frozenset(
+        product.id
+        for location in assigned_locations(user_id, establishment_id)
+        for product in location.products
+    ))
+
+
+# Данные для матрицы «пользователи × локации» текущего заведения
+def assignment_matrix(establishment_id=None):
+    establishment_id = establishment_id or current_establishment_id()
+    users = db.session.execute(
+        select(User.id, User.username)
+        .where(User.establishment_id == establishment_id)
+        .order_by(User.username)
+    ).all()
+    assigned = {
+        (user_id, location_id)
+        for user_id, location_ids in assignments_for([user.id for user in users]).items()
+        for location_id in location_ids
+    }
+    return users, location_choices(establishment_id), assigned
@@ -0,0 +1,331 @@
+from collections import defaultdict
+import csv
+from datetime import date, datetime, timedelta
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+from flask import has_request_context, request
+from flask_login import current_user
+from sqlalchemy import delete, event, inspect, insert, select
+from sqlalchemy.orm import Session
+from models import db, AuditEntry
+from tenancy import current_establishment_id
+
+# Служебные и пересчитываемые таблицы не журналируются
+EXCLUDED_TABLES = {'audit_log', 'table_versions', 'count_session_lines', 'dish_costs'}
+MASKED_COLUMNS = {'password_hash'}
+AUDIT_COLUMNS = ['id', 'created_at', 'establishment_id', 'user_id', 'username', 'action', 'table_name', 'row_id', 'changes', 'endpoint']
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple, set)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _jsonable(item) for key, item in value.items()}
+    return str(value)
+
+
+def _masked(column, value):
+    return '***' if column in MASKED_COLUMNS and value is not None else _jsonable(value)
+
+
+def _actor():
+    if not has_request_context():
+        return {'user_id': None, 'username': None, 'endpoint': None}
+    authenticated = current_user and current_user.is_authenticated
+    return {
+        'user_id': current_user.id if authenticated else None,
+        'username': current_user.username if authenticated else None,
+        'endpoint': request.endpoint,
+    }
+
+
+# Первичный ключ берётся из атрибутов: при after_flush identity новых объектов ещё не назначена
+def _row_id(state):
+    identity = [state.dict.get(state.mapper.get_property_by_column(column).key) for column in state.mapper.primary_key]
+    if all(part is None for part in identity):
+        return None
+    return ':'.join(str(part) for part in identity)
+
+
+def _instance_entry(instance, action):
+    state = inspect(instance)
+    table_name = instance.__table__.name
+    if table_name in EXCLUDED_TABLES:
+        return None
+    if action == 'update':
+        changes = {}
+        for attribute in state.mapper.column_attrs:
+            history = state.attrs[attribute.key].history
+            if history.has_changes():
+                old = history.deleted[0] if history.deleted else None
+                new = history.added[0] if history.added else None
+                # Значения из форм приходят строками: '1' вместо 1 — не изменение
+                if old is not None and new is not None and str(old) == str(new):
+                    continue
+                changes[attribute.key] = [_masked(attribute.key, old), _masked(attribute.key, new)]
+        if not changes:
+            return None
+    else:
+        # Только загруженные значения: обращение к истёкшему атрибуту удалённой строки вызвало бы запрос
+        changes = {attribute.key: _masked(attribute.key, state.dict[attribute.key]) for attribute in state.mapper.column_attrs if attribute.key in state.dict}
+    # У таблиц связей (dish_products, supplier_product и т.п.) своего заведения нет:
+    # запись относится к заведению текущего запроса, как и в _collect_bulk
+    establishment_id = getattr(instance, 'establishment_id', None)
+    if establishment_id is None:
+        establishment_id = current_establishment_id()
+    return {
+        'establishment_id': establishment_id,
+        'action': action,
+        'table_name': table_name,
+        'row_id': _row_id(state),
+        'changes': changes,
+    }
+
+
+# Изменения собираются при flush и отдаются писателю только после commit;
+# при откате транзакции собранное отбрасывается
+@event.listens_for(Session, 'after_flush')
+def _collect_flushed(session, flush_context):
+    entries = []
+    for instances, action in ((session.new, 'insert'), (session.dirty, 'update'), (session.deleted, 'delete')):
+        for instance in instances:
+            entry = _instance_entry(instance, action)
+            if entry:
+                entries.append(entry)
+    if entries:
+        actor = _actor()
+        session.info.setdefault('audit_entries', []).extend(dict(entry, **actor) for entry in entries)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_bulk(execute_state):
+    if not (execute_state.is_insert or execute_state.is_update or execute_state.is_delete):
+        return
+    statement = execute_state.statement
+    table = getattr(statement, 'table', None)
+    if table is None or table.name in EXCLUDED_TABLES:
+        return
+    # Запрос выполняется здесь, чтобы знать число изменённых строк: запрос, не изменивший
+    # ни одной (INSERT с пропуском дубликатов, UPDATE без совпадений), не журналируется.
+    # rowcount -1 (драйвер не сообщил) считается изменением
+    result = execute_state.invoke_statement()
+    if getattr(result, 'rowcount', -1) == 0:
+        return result
+    parameters = execute_state.parameters
+    action = 'bulk_insert' if execute_state.is_insert else 'bulk_update' if execute_state.is_update else 'bulk_delete'
+    if execute_state.is_insert and parameters:
+        rows = parameters if isinstance(parameters, list) else [parameters]
+        changes = {'rows': len(rows), 'sample': [_masked_row(row) for row in rows[:20]]}
+    else:
+        # UPDATE/DELETE с условием или INSERT ... SELECT: сохраняется сам запрос
+        compiled = statement.compile(dialect=execute_state.session.get_bind().dialect)
+        changes = {'statement': str(compiled), 'params': _masked_row(compiled.params)}
+        if isinstance(parameters, list):
+            changes['rows'] = len(parameters)
+            changes['sample'] = [_masked_row(row) for row in parameters[:20]]
+    execute_state.session.info.setdefault('audit_entries', []).append({
+        'establishment_id': current_establishment_id(),
+        'action': action,
+        'table_name': table.name,
+        'row_id': None,
+        'changes': changes,
+        **_actor(),
+    })
+    return result
+
+
+def _masked_row(row):
+    return {str(key): _masked(str(key), value) for key, value in dict(row).items()}
+
+
+@event.listens_for(Session, 'after_commit')
+def _enqueue_committed(session):
+    entries = session.info.pop('audit_entries', None)
+    if entries:
+        audit_writer.enqueue(entries)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back(session):
+    session.info.pop('audit_entries', None)
+
+
+_STOP = object()
+
+
+# Фоновый писатель журнала: копит записи в очереди и вставляет их пакетами до
+# batch_size строк одним executemany, выжидая до linger секунд, пока пакет
+# наполняется. Запрос только кладёт записи в очередь. При
+# переполнении очереди новые записи отбрасываются с предупреждением в лог
+class AuditWriter:
+    def __init__(self, batch_size=500, linger=0.5, max_queue=100000):
+        self.app = None
+        self.batch_size = batch_size
+        self.linger = linger
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+    def enqueue(self, entries):
+        if self.app is None:
+            return
+        created_at = datetime.now()
+        for entry in entries:
+            try:
+                self._queue.put_nowait(dict(entry, created_at=created_at))
+            except queue.Full:
+                self.dropped += 1
+                self.app.logger.warning('Очередь журнала изменений переполнена, записей потеряно: %s', self.dropped)
+        self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.linger
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                if batch[-1] is _STOP:
+                    break
+            if batch[-1] is _STOP:
+                batch.pop()
+                stopping = True
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception as e:
+                self.app.logger.exception('Ошибка записи журнала изменений (%s записей): %s', len(batch), e)
+
+    def _write(self, batch):
+        with self.app.app_context():
+            db.session.execute(insert(AuditEntry), batch)
+            db.session.commit()
+
+    # Синхронно дописывает всё, что накопилось в очереди (для CLI и остановки процесса)
+    def drain(self):
+        batch = []
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is not _STOP:
+                batch.append(entry)
+        if batch:
+            self._write(batch)
+        return len(batch)
+
+    # Остановка процесса (atexit): поток дописывает пакет, который уже собирает,
+    # затем записывается всё, что осталось в очереди
+    def stop(self, timeout=10.0):
+        with self._lock:
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+                thread.join(timeout)
+            except queue.Full:
+                pass
+            with self._lock:
+                self._thread = None
+        return self.drain()
+
+
+audit_writer = AuditWriter()
+
+
+# Страница журнала с фильтрами; постраничный переход по id (before_id), без OFFSET и COUNT.
+# Записи без заведения (изменения вне запроса: CLI, фоновые потоки) не считаются общими
+# и видны только без выбранного заведения
+def audit_entries(filters, before_id=None, per_page=50):
+    query = select(AuditEntry).order_by(AuditEntry.id.desc()).limit(per_page + 1)
+    establishment_id = current_establishment_id()
+    if establishment_id is not None:
+        query = query.where(AuditEntry.establishment_id == establishment_id)
+    if before_id:
+        query = query.where(AuditEntry.id < before_id)
+    for column in ('table_name', 'action', 'row_id', 'username'):
+        if filters.get(column):
+            query = query.where(getattr(AuditEntry, column) == filters[column])
+    if filters.get('date_from'):
+        query = query.where(AuditEntry.created_at >= filters['date_from'])
+    if filters.get('date_to'):
+        query = query.where(AuditEntry.created_at < filters['date_to'] + timedelta(days=1))
+    entries = db.session.scalars(query).all()
+    next_before = entries[per_page - 1].id if len(entries) > per_page else None
+    return entries[:per_page], next_before
+
+
+def audited_tables():
+    return sorted(set(db.metadata.tables) - EXCLUDED_TABLES)
+
+
+# Политика хранения: записи старше keep_days выгружаются помесячно в
+# archive_folder/audit_ГГГГ_ММ.csv.gz (месяц дописывается, если файл уже есть)
+# и удаляются из таблицы порциями по batch_size
+def apply_retention(keep_days=180, archive_folder=None, batch_size=5000):
+    cutoff = datetime.combine(date.today() - timedelta(days=keep_days), datetime.min.time())
+    removed = 0
+    while True:
+        entries = db.session.execute(
+            select(*(getattr(AuditEntry, column) for column in AUDIT_COLUMNS))
+            .where(AuditEntry.created_at < cutoff)
+            .order_by(AuditEntry.id)
+            .limit(batch_size)
+            .execution_options(skip_tenant_scope=True)
+        ).all()
+        if not entries:
+            return removed
+        if archive_folder:
+            _archive(entries, archive_folder)
+        db.session.execute(
+            delete(AuditEntry).where(AuditEntry.id.in_([entry.id for entry in entries]))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        removed += len(entries)
+
+
+def _archive(entries, folder):
+    os.makedirs(folder, exist_ok=True)
+    months = defaultdict(list)
+    for entry in entries:
+        months[entry.created_at.strftime('%Y_%m')].append(entry)
+    for month, rows in months.items():
+        path = os.path.join(folder, f'audit_{month}.csv.gz')
+        new_file = not os.path.exists(path)
+        with gzip.open(path, 'at', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            if new_file:
+                writer.writerow(AUDIT_COLUMNS)
+            writer.writerows([_csv_value(value) for value in row] for row in rows)
+
+
+def _csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return _jsonable(value)
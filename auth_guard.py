@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from functools import wraps
+import math
+import threading
+import time
+from flask import make_response, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# Token bucket в памяти процесса: capacity попыток подряд, затем по одной каждые
+# 1 / rate секунд. Полностью восстановившиеся корзины удаляются, когда ключей
+# становится больше max_keys, поэтому перебор случайных имён не раздувает память
+class RateLimiter:
+    def __init__(self, capacity, rate, max_keys=10000):
+        self.capacity = capacity
+        self.rate = rate
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    # Списывает попытку; возвращает 0, если она разрешена, иначе сколько секунд ждать
+    def hit(self, key, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now)
+                if len(self._buckets) > self.max_keys:
+                    self._prune(now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (cost - tokens) / self.rate
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def _prune(self, now):
+        refill = self.capacity / self.rate
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < refill}
+
+
+# Адрес клиента для ограничений. За обратным прокси remote_addr — адрес прокси, и все
+# клиенты делят одну корзину: число доверенных прокси задаётся TRUSTED_PROXIES,
+# тогда адрес берётся из X-Forwarded-For (ProxyFix в app.py)
+def client_ip():
+    return request.remote_addr or 'unknown'
+
+
+def form_username():
+    username = (request.form.get('username') or '').strip().lower()
+    return username or None
+
+
+# Ограничивает POST-запросы к маршруту. rules — пары (limiter, функция ключа);
+# ключ None правило пропускает. Время проверки отдаётся в заголовке Server-Timing
+def rate_limited(*rules):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'POST':
+                return view(*args, **kwargs)
+            started = time.perf_counter()
+            retry_after = 0
+            for limiter, key_func in rules:
+                key = key_func()
+                if key is not None:
+                    retry_after = max(retry_after, limiter.hit(key))
+            elapsed = time.perf_counter() - started
+            if retry_after:
+                response = TooManyRequests('Слишком много попыток, попробуйте позже.', retry_after=math.ceil(retry_after)).get_response()
+            else:
+                response = make_response(view(*args, **kwargs))
+            response.headers.add('Server-Timing', f'ratelimit;dur={elapsed * 1000:.3f}')
+            return response
+        return wrapper
+    return decorator
+
+
+# Списывает неудачную попытку по ключу (ключ None пропускается); когда корзина пуста —
+# 429 с Retry-After. Удачная попытка корзину не тратит, поэтому чужие неверные пароли
+# к имени не мешают войти его владельцу
+def charge_failure(limiter, key):
+    if key is None:
+        return
+    retry_after = limiter.hit(key)
+    if retry_after:
+        raise TooManyRequests('Слишком много попыток, попробуйте позже.', retry_after=math.ceil(retry_after))
+
+
+# Хэширование и проверка паролей в отдельном пуле из max_workers потоков.
+# Одновременно ждать своей очереди могут не больше max_pending запросов, остальные
+# сразу получают 503 — поток подбора паролей не занимает все обработчики
+class PasswordHasher:
+    def __init__(self, max_workers=2, max_pending=8, timeout=10.0):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise ServiceUnavailable('Сервер занят, попробуйте через несколько секунд.', retry_after=1)
+        future = self._executor.submit(function, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise ServiceUnavailable('Сервер занят, попробуйте через несколько секунд.', retry_after=1)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password)
@@ -0,0 +1,165 @@
+from collections import defaultdict
+import threading
+import time
+from sqlalchemy import select, text
+from models import db, DishComponent, DishProduct
+
+
+class RecipeCycleError(ValueError):
+    def __init__(self, cycle):
+        super().__init__('Рецепт ссылается сам на себя: ' + ' → '.join(str(dish_id) for dish_id in cycle))
+        self.cycle = cycle
+
+
+# Порядок обхода, в котором каждый полуфабрикат идёт раньше блюд, куда он входит.
+# Блюда из done пропускаются вместе со всем их составом
+def topological_order(dish_ids, components, done=()):
+    order, state = [], {}
+    for root in dish_ids:
+        if root in done or root in state:
+            continue
+        state[root] = 'open'
+        path, stack = [root], [iter(components.get(root, ()))]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                finished = path.pop()
+                state[finished] = 'closed'
+                order.append(finished)
+                continue
+            if child in done or state.get(child) == 'closed':
+                continue
+            if state.get(child) == 'open':
+                raise RecipeCycleError(path[path.index(child):] + [child])
+            state[child] = 'open'
+            path.append(child)
+            stack.append(iter(components.get(child, ())))
+    return order
+
+
+# Раскладывает блюда с полуфабрикатами на сырьё: {dish_id: {product_id: количество}}.
+# Граф рецептов читается из базы двумя запросами и хранится в памяти; развёрнутые
+# рецепты запоминаются. При изменении рецепта сбрасываются только он сам и блюда,
+# в которые он входит
+class RecipeExpander:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._graph = None
+        self._flat = {}
+
+    def _load_graph(self):
+        products, components, parents = defaultdict(dict), defaultdict(dict), defaultdict(set)
+        for dish_id, product_id, quantity in db.session.execute(
+            select(DishProduct.dish_id, DishProduct.product_id, DishProduct.quantity)
+        ):
+            products[dish_id][product_id] = quantity
+        for dish_id, component_id, quantity in db.session.execute(
+            select(DishComponent.dish_id, DishComponent.component_id, DishComponent.quantity)
+        ):
+            components[dish_id][component_id] = quantity
+            parents[component_id].add(dish_id)
+        return products, components, parents
+
+    def _graph_locked(self):
+        if self._graph is None:
+            self._graph = self._load_graph()
+        return self._graph
+
+    def flatten(self, dish_ids):
+        with self._lock:
+            products, components, _ = self._graph_locked()
+            for dish_id in topological_order(dish_ids, components, done=self._flat):
+                flat = dict(products.get(dish_id, {}))
+                for component_id, portions in components.get(dish_id, {}).items():
+                    for product_id, quantity in self._flat[component_id].items():
+                        flat[product_id] = flat.get(product_id, 0.0) + portions * quantity
+                self._flat[dish_id] = flat
+            return {dish_id: self._flat[dish_id] for dish_id in dish_ids}
+
+    # Блюда, в которые указанные входят напрямую или через другие полуфабрикаты
+    def ancestors(self, dish_ids):
+        with self._lock:
+            _, _, parents = self._graph_locked()
+            return self._ancestors(dish_ids, parents)
+
+    @staticmethod
+    def _ancestors(dish_ids, parents):
+        found, pending = set(), list(dish_ids)
+        while pending:
+            for parent in parents.get(pending.pop(), ()):
+                if parent not in found:
+                    found.add(parent)
+                    pending.append(parent)
+        return found
+
+    # Проверяет, что новый состав блюда не создаёт цикл (блюдо внутри самого себя)
+    def check_components(self, dish_id, component_ids):
+        with self._lock:
+            _, components, _ = self._graph_locked()
+            proposed = dict(components)
+            proposed[dish_id] = dict.fromkeys(component_ids)
+            topological_order([dish_id], proposed)
+
+    # Вызывается после изменения состава блюд, до пересчёта зависимых данных
+    def invalidate(self, dish_ids=None):
+        with self._lock:
+            if dish_ids is None or self._graph is None:
+                self._flat.clear()
+            else:
+                for dish_id in set(dish_ids) | self._ancestors(dish_ids, self._graph[2]):
+                    self._flat.pop(dish_id, None)
+            self._graph = None
+
+
+recipe_expander = RecipeExpander()
+
+
+def flatten_dish(dish_id):
+    return recipe_expander.flatten([dish_id])[dish_id]
+
+
+_components_write_lock = threading.Lock()
+
+
+# Заменяет полуфабрикаты блюда: components — {component_id: порций}.
+# Быстрая проверка идёт по графу в памяти, окончательная — по базе внутри той же
+# транзакции, что и запись. Изменения составов выполняются по одному (блокировка
+# процесса и, в PostgreSQL, транзакционная advisory-блокировка), поэтому два
+# встречных изменения (A→B и B→A) не могут оба пройти проверку
+def set_dish_components(dish_id, components):
+    recipe_expander.check_components(dish_id, components)
+    with _components_write_lock:
+        if db.session.get_bind().dialect.name == 'postgresql':
+            db.session.execute(text('SELECT pg_advisory_xact_lock(hashtext(:name))'), {'name': 'dish_components'})
+        DishComponent.query.filter_by(dish_id=dish_id).delete()
+        db.session.add_all(
+            DishComponent(dish_id=dish_id, component_id=component_id, quantity=quantity)
+            for component_id, quantity in components.items()
+        )
+        db.session.flush()
+        graph = defaultdict(dict)
+        for parent_id, component_id in db.session.execute(select(DishComponent.dish_id, DishComponent.component_id)):
+            graph[parent_id][component_id] = None
+        try:
+            topological_order([dish_id], graph)
+        except RecipeCycleError:
+            db.session.rollback()
+            raise
+        db.session.commit()
+    recipe_expander.invalidate([dish_id])
+
+
+# Время разворачивания всего меню: с пустым кэшем (включая чтение графа) и повторно
+def benchmark_menu(dish_ids, repeat=5):
+    timings = {}
+    recipe_expander.invalidate()
+    started = time.perf_counter()
+    flattened = recipe_expander.flatten(dish_ids)
+    timings['cold'] = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(repeat):
+        recipe_expander.flatten(dish_ids)
+    timings['warm'] = (time.perf_counter() - started) / repeat
+    timings['products'] = sum(len(flat) for flat in flattened.values())
+    return timings
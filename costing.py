@@ -0,0 +1,131 @@
+from datetime import date, datetime
+from sqlalchemy import and_, delete, func, insert, select
+from bom import recipe_expander
+from models import db, Dish, DishCost, DishProduct, ProductPrice
+
+
+# Действующая на дату цена каждого продукта: для каждого поставщика берётся последняя
+# цена с effective_from <= on_date, из них — минимальная
+def _current_prices(on_date):
+    latest = (
+        select(ProductPrice.product_id, ProductPrice.supplier_id, func.max(ProductPrice.effective_from).label('effective_from'))
+        .where(ProductPrice.effective_from <= on_date)
+        .group_by(ProductPrice.product_id, ProductPrice.supplier_id)
+        .subquery()
+    )
+    # Несколько цен на одну дату у одного поставщика — действует последняя введённая
+    newest = (
+        select(func.max(ProductPrice.id))
+        .join(latest, and_(
+            ProductPrice.product_id == latest.c.product_id,
+            ProductPrice.supplier_id.is_not_distinct_from(latest.c.supplier_id),
+            ProductPrice.effective_from == latest.c.effective_from,
+        ))
+        .group_by(ProductPrice.product_id, ProductPrice.supplier_id)
+    )
+    return (
+        select(ProductPrice.product_id, func.min(ProductPrice.unit_price).label('unit_price'))
+        .where(ProductPrice.id.in_(newest))
+        .group_by(ProductPrice.product_id)
+        .subquery()
+    )
+
+
+# Ближайшее будущее изменение цены каждого продукта
+def _next_price_changes(on_date):
+    return (
+        select(ProductPrice.product_id, func.min(ProductPrice.effective_from).label('effective_from'))
+        .where(ProductPrice.effective_from > on_date)
+        .group_by(ProductPrice.product_id)
+        .subquery()
+    )
+
+
+def dishes_for_products(product_ids):
+    return set(db.session.scalars(
+        select(DishProduct.dish_id).where(DishProduct.product_id.in_(product_ids)).distinct()
+        .execution_options(skip_tenant_scope=True)
+    ))
+
+
+# Пересчитывает агрегаты себестоимости для указанных блюд и блюд, в которые они входят
+# как полуфабрикаты. Состав берётся из развёрнутых до сырья рецептов
+def recompute_dish_costs(dish_ids):
+    dish_ids = set(dish_ids)
+    if not dish_ids:
+        return
+    dish_ids |= recipe_expander.ancestors(dish_ids)
+    establishments = dict(db.session.execute(
+        select(Dish.id, Dish.establishment_id).where(Dish.id.in_(dish_ids))
+        .execution_options(skip_tenant_scope=True)
+    ).all())
+    flattened = recipe_expander.flatten(list(establishments))
+    product_ids = set().union(*flattened.values())
+
+    on_date = date.today()
+    prices, changes = _current_prices(on_date), _next_price_changes(on_date)
+    unit_prices = dict(db.session.execute(
+        select(prices.c.product_id, prices.c.unit_price).where(prices.c.product_id.in_(product_ids))
+    ).all())
+    next_changes = dict(db.session.execute(
+        select(changes.c.product_id, changes.c.effective_from).where(changes.c.product_id.in_(product_ids))
+    ).all())
+
+    now = datetime.now()
+    rows = []
+    for dish_id, establishment_id in establishments.items():
+        flat = flattened[dish_id]
+        priced = [product_id for product_id in flat if product_id in unit_prices]
+        rows.append({
+            'dish_id': dish_id, 'establishment_id': establishment_id,
+            'cost': sum(flat[product_id] * unit_prices[product_id] for product_id in priced),
+            'priced_lines': len(priced), 'missing_lines': len(flat) - len(priced),
+            'valid_until': min((next_changes[product_id] for product_id in flat if product_id in next_changes), default=None),
+            'updated_at': now,
+        })
+
+    db.session.execute(
+        delete(DishCost).where(DishCost.dish_id.in_(dish_ids)).execution_options(synchronize_session=False)
+    )
+    if rows:
+        db.session.execute(insert(DishCost), rows)
+    db.session.commit()
+
+
+# Добавляет цены (словари с product_id, supplier_id, unit_price, effective_from)
+# и пересчитывает только блюда, в которых есть эти продукты (в том числе через полуфабрикаты)
+def set_product_prices(prices):
+    prices = [dict(price, effective_from=price.get('effective_from') or date.today()) for price in prices]
+    if not prices:
+        return
+    db.session.execute(insert(ProductPrice), prices)
+    db.session.commit()
+    recompute_dish_costs(dishes_for_products({price['product_id'] for price in prices}))
+
+
+def price_history(product_id):
+    return db.session.execute(
+        select(ProductPrice.supplier_id, ProductPrice.unit_price, ProductPrice.effective_from)
+        .where(ProductPrice.product_id == product_id)
+        .order_by(ProductPrice.effective_from.desc(), ProductPrice.id.desc())
+    ).all()
+
+
+def dish_cost(dish_id):
+    return db.session.get(DishCost, dish_id)
+
+
+# Себестоимость всего меню из таблицы агрегатов. Пересчитываются только блюда без
+# агрегата или те, у которых наступила дата изменения цены
+def menu_costs():
+    stale = db.session.scalars(
+        select(Dish.id)
+        .outerjoin(DishCost, DishCost.dish_id == Dish.id)
+        .where((DishCost.dish_id.is_(None)) | (DishCost.valid_until <= date.today()))
+    ).all()
+    recompute_dish_costs(stale)
+    return db.session.execute(
+        select(Dish.id, Dish.name, DishCost.cost, DishCost.priced_lines, DishCost.missing_lines)
+        .join(DishCost, DishCost.dish_id == Dish.id)
+        .order_by(Dish.name)
+    ).all()
@@ -2,6 +2,7 @@ from functools import wraps
 from flask import abort
 from flask_login import current_user
 from flask import g
+from tenancy import establishment_names
 
 def role_required(role):
     def decorator(func):
@@ -25,6 +26,6 @@ def user_details(f):
         g.establishment_id = current_user.establishment_id
         g.username = current_user.username
         g.role = current_user.role.capitalize()
-        g.establishment_name = "Лукашевича" if g.establishment_id == 1 else "Ленина"
+        g.establishment_name = establishment_names().get(g.establishment_id, '')
         return f(*args, **kwargs)
     return decorated_function
@@ -0,0 +1,326 @@
+import asyncio
+import base64
+from collections import namedtuple
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from io import BytesIO
+import json
+import os
+import re
+import smtplib
+import threading
+import uuid
+from urllib.request import Request, urlopen
+import pandas as pd
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.orm import joinedload
+from werkzeug.utils import secure_filename
+from models import db, OrderOutbox, Supplier
+
+# Файлы заявок лежат в instance/ и отдаются только через download_order_file
+# (вход и проверка заведения), а не как статика
+ORDERS_FOLDER = 'orders'
+
+EMAIL_PATTERN = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
+
+OrderMessage = namedtuple('OrderMessage', ['order_id', 'supplier_name', 'recipient', 'subject', 'file_name', 'content', 'mimetype', 'payload'])
+
+MIMETYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'pdf': 'application/pdf',
+}
+
+
+# Отправка заявок письмом; для отладки подходит локальный сервер
+# `python -m aiosmtpd -n -l localhost:1025`. Одно SMTP-соединение на пакет
+class SmtpTransport:
+    def __init__(self, host='localhost', port=1025, sender='orders@localhost'):
+        self.host = host
+        self.port = port
+        self.sender = sender
+
+    def deliver(self, messages):
+        errors = []
+        with smtplib.SMTP(self.host, self.port, timeout=10) as smtp:
+            for message in messages:
+                if not message.recipient:
+                    errors.append('У поставщика не указан email')
+                    continue
+                email = EmailMessage()
+                email['Subject'] = message.subject
+                email['From'] = self.sender
+                email['To'] = message.recipient
+                email.set_content(message.subject)
+                maintype, subtype = message.mimetype.split('/')
+                email.add_attachment(message.content, maintype=maintype, subtype=subtype, filename=message.file_name)
+                try:
+                    smtp.send_message(email)
+                    errors.append(None)
+                except smtplib.SMTPException as e:
+                    errors.append(str(e))
+        return errors
+
+
+# Отправка заявок POST-запросом с JSON (файл в base64), например на локальную заглушку
+class WebhookTransport:
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def deliver(self, messages):
+        errors = []
+        for message in messages:
+            body = json.dumps({
+                'order_id': message.order_id,
+                'supplier': message.supplier_name,
+                'recipient': message.recipient,
+                'subject': message.subject,
+                'file_name': message.file_name,
+                'content': base64.b64encode(message.content).decode('ascii'),
+                'lines': message.payload['lines'],
+            }).encode('utf-8')
+            request = Request(self.url, data=body, headers={'Content-Type': 'application/json'}, method='POST')
+            try:
+                with urlopen(request, timeout=self.timeout):
+                    errors.append(None)
+            except OSError as e:
+                errors.append(str(e))
+        return errors
+
+
+# Адрес поставщика из формы: пустое поле — адреса нет, неверный адрес — ValueError
+def parse_supplier_email(value):
+    value = (value or '').strip()
+    if not value:
+        return None
+    if len(value) > 120 or not EMAIL_PATTERN.fullmatch(value):
+        raise ValueError(value)
+    return value
+
+
+TRANSPORTS = {
+    'smtp': lambda config: SmtpTransport(config.get('ORDER_SMTP_HOST', 'localhost'), int(config.get('ORDER_SMTP_PORT', 1025)), config.get('ORDER_MAIL_SENDER', 'orders@localhost')),
+    'webhook': lambda config: WebhookTransport(config['ORDER_WEBHOOK_URL']),
+}
+
+
+def transport_from_config(config):
+    name = config.get('ORDER_TRANSPORT')
+    return TRANSPORTS[name](config) if name else None
+
+
+def render_order_xlsx(payload):
+    buffer = BytesIO()
+    pd.DataFrame(payload['lines']).to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def render_order_pdf(payload):
+    buffer = BytesIO()
+    document = SimpleDocTemplate(buffer, pagesize=A4, title=payload['title'])
+    data = [['Product Name', 'Measurement', 'Quantity']] + [
+        [line['Product Name'], line['Measurement'], f"{line['Quantity']:g}"] for line in payload['lines']
+    ]
+    table = Table(data, colWidths=[300, 100, 80])
+    table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (-1, 0), 'DejaVuSans-Bold'),
+        ('FONTNAME', (0, 1), (-1, -1), 'DejaVuSans'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ]))
+    document.build([table])
+    return buffer.getvalue()
+
+
+RENDERERS = {'xlsx': render_order_xlsx, 'pdf': render_order_pdf}
+
+
+# Фоновый обработчик очереди: asyncio-цикл в отдельном потоке забирает пакеты
+# готовых к отправке заявок, рендерит файлы параллельно и передаёт их транспорту.
+# Неудачные попытки повторяются с экспоненциальной задержкой.
+# Заявка берётся в работу с меткой обработчика на lease секунд, поэтому несколько
+# обработчиков не отправят её дважды; заявка упавшего обработчика возвращается в
+# очередь, когда срок истёк. autostart=False — заявки обрабатывает отдельный процесс
+# (flask dispatch-orders), поток в веб-приложении не запускается
+class OrderDispatcher:
+    def __init__(self, app, transport=None, batch_size=20, poll_interval=5.0, max_attempts=5, backoff_base=10.0, lease=300.0, autostart=True):
+        self.app = app
+        self.transport = transport
+        self.lease = lease
+        self.autostart = autostart
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self._loop = None
+        self._wakeup = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=lambda: asyncio.run(self.run()), name='order-dispatcher', daemon=True)
+                self._thread.start()
+
+    # Будит обработчик сразу после новой заявки, не дожидаясь очередного опроса
+    def wake(self):
+        if not self.autostart:
+            return
+        self.start()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        while True:
+            try:
+                processed = await self.process_batch()
+            except Exception as e:
+                # Ошибка базы не должна останавливать обработчик: повторим на следующем опросе
+                self.app.logger.exception('Ошибка обработки очереди заявок: %s', e)
+                processed = 0
+            if processed == self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def process_batch(self):
+        token, messages = await asyncio.to_thread(self._claim_batch)
+        if not messages:
+            return 0
+        results = await asyncio.gather(*(asyncio.to_thread(self._render, message) for message in messages), return_exceptions=True)
+        errors = {}
+        rendered = []
+        for message, result in zip(messages, results):
+            if isinstance(result, Exception):
+                errors[message.order_id] = f'Ошибка генерации файла: {result}'
+            else:
+                rendered.append(result)
+
+        if rendered and self.transport is not None:
+            try:
+                delivered = await asyncio.to_thread(self.transport.deliver, rendered)
+            except Exception as e:
+                delivered = [str(e)] * len(rendered)
+            errors.update({message.order_id: error for message, error in zip(rendered, delivered) if error})
+
+        await asyncio.to_thread(self._record_results, token, messages, {message.order_id for message in rendered}, errors)
+        return len(messages)
+
+    # Захват пакета одним UPDATE с условием на статус: строку, которую уже захватил
+    # другой обработчик, UPDATE не изменит. Захваченное затем читается по своей метке
+    def _claim_batch(self):
+        token = uuid.uuid4().hex
+        now = datetime.now()
+        claimable = or_(
+            and_(OrderOutbox.status == 'pending', OrderOutbox.next_attempt_at <= now),
+            and_(OrderOutbox.status == 'sending', or_(OrderOutbox.claimed_until.is_(None), OrderOutbox.claimed_until < now)),
+        )
+        with self.app.app_context():
+            candidates = db.session.scalars(
+                select(OrderOutbox.id).where(claimable).order_by(OrderOutbox.next_attempt_at).limit(self.batch_size)
+            ).all()
+            if not candidates:
+                return token, []
+            db.session.execute(
+                update(OrderOutbox)
+                .where(OrderOutbox.id.in_(candidates), claimable)
+                .values(status='sending', claim_token=token, claimed_until=now + timedelta(seconds=self.lease))
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            rows = db.session.execute(
+                select(OrderOutbox.id, OrderOutbox.file_format, OrderOutbox.payload, Supplier.name, Supplier.email)
+                .join(Supplier, Supplier.id == OrderOutbox.supplier_id)
+                .where(OrderOutbox.claim_token == token, OrderOutbox.status == 'sending')
+                .order_by(OrderOutbox.next_attempt_at)
+            ).all()
+            db.session.commit()
+        return token, [
+            OrderMessage(row.id, row.name, row.email, row.payload['title'], f"{row.payload['title']}.{row.file_format}", None, MIMETYPES[row.file_format], row.payload)
+            for row in rows
+        ]
+
+    def _render(self, message):
+        content = RENDERERS[message.file_name.rsplit('.', 1)[1]](message.payload)
+        folder = os.path.join(self.app.instance_path, ORDERS_FOLDER)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, order_file_name(message.order_id, message.file_name)), 'wb') as file:
+            file.write(content)
+        return message._replace(content=content)
+
+    # Результаты записываются только для заявок, которые всё ещё захвачены этим обработчиком
+    def _record_results(self, token, messages, rendered_ids, errors):
+        now = datetime.now()
+        with self.app.app_context():
+            orders = {order.id: order for order in OrderOutbox.query.filter(
+                OrderOutbox.id.in_([message.order_id for message in messages]), OrderOutbox.claim_token == token,
+            )}
+            for message in messages:
+                order = orders.get(message.order_id)
+                if order is None:
+                    continue
+                order.claim_token = None
+                order.claimed_until = None
+                if message.order_id in rendered_ids:
+                    order.file_name = order_file_name(message.order_id, message.file_name)
+                error = errors.get(message.order_id)
+                if error is None:
+                    order.status = 'sent' if self.transport is not None else 'rendered'
+                    order.sent_at = now
+                    order.last_error = None
+                    continue
+                order.attempts += 1
+                order.last_error = error
+                if order.attempts >= self.max_attempts:
+                    order.status = 'failed'
+                else:
+                    order.status = 'pending'
+                    order.next_attempt_at = now + timedelta(seconds=self.backoff_base * 2 ** (order.attempts - 1))
+            db.session.commit()
+
+
+# Имя файла на диске: название заявки содержит имя поставщика, поэтому «/» и «..»
+# из него убираются; номер заявки в начале сохраняет имя уникальным
+def order_file_name(order_id, file_name):
+    return f'{order_id}_{secure_filename(file_name)}'
+
+
+# Создаёт заявку в очереди; файл будет сгенерирован и отправлен в фоне
+def enqueue_order(dispatcher, supplier, lines, establishment_id, establishment_name, user_id=None, file_format='xlsx'):
+    created_at = datetime.now()
+    order = OrderOutbox(
+        establishment_id=establishment_id,
+        supplier_id=supplier.id,
+        user_id=user_id,
+        file_format=file_format if file_format in RENDERERS else 'xlsx',
+        payload={
+            'title': f"Заявка_{supplier.name}_{establishment_name}_{created_at.strftime('%d.%m')}",
+            'lines': lines,
+        },
+        created_at=created_at,
+        next_attempt_at=created_at,
+    )
+    db.session.add(order)
+    db.session.commit()
+    dispatcher.wake()
+    return order.id
+
+
+def recent_orders(limit=20):
+    return (
+        OrderOutbox.query.options(joinedload(OrderOutbox.supplier))
+        .order_by(OrderOutbox.created_at.desc())
+        .limit(limit)
+        .all()
+    )
@@ -0,0 +1,297 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import csv
+from datetime import datetime
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import zipfile
+from sqlalchemy import JSON, Boolean, Date, DateTime, Float, Integer, create_engine, func, insert, or_, select
+from models import (
+    db, CountSession, CountSessionLine, Dish, DishComponent, DishCost, DishProduct, Establishment, InventorySnapshot,
+    InventorySnapshotLine, Location, Measurement, OrderOutbox, Product, ProductPrice, Supplier, SupplierProduct, User,
+    UserProductLocation,
+)
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+CHUNK_SIZE = 50000
+
+# name — имя таблицы и файла в архиве; query(establishment_id) — запрос строк;
+# changed_at — колонка для выгрузки изменений с момента since (None — таблица всегда целиком)
+ExportTable = namedtuple('ExportTable', ['name', 'query', 'changed_at'])
+
+
+def _table_query(model, scope=None, join=None, exclude=()):
+    def query(establishment_id):
+        statement = select(*(column for column in model.__table__.columns if column.name not in exclude))
+        if join is not None:
+            statement = statement.join(*join)
+        if establishment_id is not None and scope is not None:
+            statement = statement.where(or_(scope == establishment_id, scope.is_(None)))
+        return statement.order_by(*model.__table__.primary_key)
+    return query
+
+
+# Таблицы выгрузки. Служебные таблицы, журнал изменений (у него свой архив, см. audit.py)
+# и хэши паролей не выгружаются; таблицы без своего заведения ограничиваются через родителя
+EXPORT_TABLES = [
+    ExportTable('establishments', _table_query(Establishment, Establishment.id), None),
+    ExportTable('measurement', _table_query(Measurement), None),
+    ExportTable('location', _table_query(Location, Location.establishment_id), None),
+    ExportTable('products', _table_query(Product, Product.establishment_id), None),
+    ExportTable('suppliers', _table_query(Supplier, Supplier.establishment_id), None),
+    ExportTable('supplier_product', _table_query(SupplierProduct, Product.establishment_id, (Product, Product.id == SupplierProduct.product_id)), None),
+    ExportTable('product_prices', _table_query(ProductPrice, Product.establishment_id, (Product, Product.id == ProductPrice.product_id)), None),
+    ExportTable('dishes', _table_query(Dish, Dish.establishment_id, exclude=('preparation_steps', 'preparation_html')), None),
+    ExportTable('dish_products', _table_query(DishProduct, Dish.establishment_id, (Dish, Dish.id == DishProduct.dish_id)), None),
+    ExportTable('dish_components', _table_query(DishComponent, Dish.establishment_id, (Dish, Dish.id == DishComponent.dish_id)), None),
+    ExportTable('dish_costs', _table_query(DishCost, DishCost.establishment_id), DishCost.updated_at),
+    ExportTable('users', _table_query(User, User.establishment_id, exclude=('password_hash',)), None),
+    ExportTable('user_product_location', _table_query(UserProductLocation, User.establishment_id, (User, User.id == UserProductLocation.user_id)), None),
+    ExportTable('inventory_snapshots', _table_query(InventorySnapshot, InventorySnapshot.establishment_id), InventorySnapshot.created_at),
+    ExportTable(
+        'inventory_snapshot_lines',
+        _table_query(InventorySnapshotLine, InventorySnapshotLine.establishment_id, (InventorySnapshot, InventorySnapshot.id == InventorySnapshotLine.snapshot_id)),
+        InventorySnapshot.created_at,
+    ),
+    ExportTable('count_sessions', _table_query(CountSession, CountSession.establishment_id), func.coalesce(CountSession.closed_at, CountSession.created_at)),
+    ExportTable(
+        'count_session_lines',
+        _table_query(CountSessionLine, CountSession.establishment_id, (CountSession, CountSession.id == CountSessionLine.session_id)),
+        CountSessionLine.updated_at,
+    ),
+    ExportTable('order_outbox', _table_query(OrderOutbox, OrderOutbox.establishment_id), func.coalesce(OrderOutbox.sent_at, OrderOutbox.created_at)),
+]
+
+
+# Форматы в порядке предпочтения: Parquet и Arrow IPC требуют pyarrow,
+# CSV со сжатием gzip доступен всегда
+def available_formats():
+    formats = []
+    if pq is not None:
+        formats.append('parquet')
+    if pa is not None:
+        formats.append('arrow')
+    formats.append('csv')
+    return formats
+
+
+def _arrow_type(column_type):
+    if isinstance(column_type, Boolean):
+        return pa.bool_()
+    if isinstance(column_type, Integer):
+        return pa.int64()
+    if isinstance(column_type, Float):
+        return pa.float64()
+    if isinstance(column_type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(column_type, Date):
+        return pa.date32()
+    return pa.string()
+
+
+class _CsvWriter:
+    def __init__(self, path, columns):
+        self._file = gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=6)
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([column.name for column in columns])
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+# Каждая порция строк становится отдельной row group (Parquet) или record batch (Arrow IPC)
+class _ArrowWriter:
+    def __init__(self, path, columns, parquet):
+        self._schema = pa.schema([(column.name, _arrow_type(column.type)) for column in columns])
+        if parquet:
+            self._writer = pq.ParquetWriter(path, self._schema, compression='zstd')
+        else:
+            self._writer = pa.ipc.new_file(path, self._schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+        self._parquet = parquet
+
+    def write(self, rows):
+        values = list(zip(*rows))
+        batch = pa.record_batch(
+            [pa.array(column, type=field.type) for column, field in zip(values, self._schema)],
+            schema=self._schema,
+        )
+        if self._parquet:
+            self._writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+
+    def close(self):
+        self._writer.close()
+
+
+def _writer(file_format, path, columns):
+    if file_format == 'csv':
+        return _CsvWriter(path, columns)
+    return _ArrowWriter(path, columns, parquet=file_format == 'parquet')
+
+
+FILE_EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow', 'csv': 'csv.gz'}
+
+
+# Потоковая запись результата запроса в файл порциями по chunk_size строк:
+# в памяти одновременно не больше одной порции
+def _write_table(connection, query, path, file_format, chunk_size=CHUNK_SIZE):
+    columns = list(query.selected_columns)
+    json_positions = [position for position, column in enumerate(columns) if isinstance(column.type, JSON)]
+    writer = _writer(file_format, path, columns)
+    written = 0
+    try:
+        result = connection.execution_options(yield_per=chunk_size).execute(query)
+        for rows in result.partitions():
+            if json_positions:
+                rows = [_with_json_text(row, json_positions) for row in rows]
+            writer.write(rows)
+            written += len(rows)
+    finally:
+        writer.close()
+    return written
+
+
+def _with_json_text(row, positions):
+    row = list(row)
+    for position in positions:
+        if row[position] is not None:
+            row[position] = json.dumps(row[position], ensure_ascii=False)
+    return row
+
+
+# Все таблицы читаются из одного согласованного состояния базы: строки инвентаризации
+# не могут оказаться без своей шапки. В PostgreSQL — одна транзакция REPEATABLE READ.
+# Открытая на всю выгрузку транзакция SQLite (в режиме журнала по умолчанию) не даёт
+# писать в базу, поэтому файловая база сначала копируется через backup API порциями
+# по backup_pages страниц — запись блокируется только на время одной порции — и
+# выгрузка читает копию. copy=False читает саму базу в явной транзакции
+@contextmanager
+def _snapshot_connection(engine, copy=True, backup_pages=1024):
+    database = engine.url.database
+    if engine.dialect.name == 'sqlite' and copy and database and database != ':memory:':
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'snapshot.db')
+            source, target = sqlite3.connect(database), sqlite3.connect(path)
+            try:
+                source.backup(target, pages=backup_pages)
+            finally:
+                source.close()
+                target.close()
+            snapshot = create_engine(f'sqlite:///{path}')
+            try:
+                with _snapshot_connection(snapshot, copy=False) as connection:
+                    yield connection
+            finally:
+                snapshot.dispose()
+        return
+    with engine.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execution_options(isolation_level='REPEATABLE READ', postgresql_readonly=True)
+        elif connection.dialect.name == 'sqlite':
+            connection.exec_driver_sql('BEGIN')
+        try:
+            yield connection
+        finally:
+            connection.rollback()
+
+
+# Выгрузка в zip-архив target (путь или файловый объект): по файлу на таблицу и
+# manifest.json с числом строк. establishment_id None — все заведения. С since
+# таблицы с меткой времени содержат только строки, изменённые начиная с since;
+# until из манифеста подходит как since для следующей выгрузки
+def write_export(target, establishment_id=None, since=None, file_format=None, chunk_size=CHUNK_SIZE):
+    file_format = file_format or available_formats()[0]
+    if file_format not in available_formats():
+        raise ValueError(f'Формат {file_format} недоступен: установите pyarrow')
+    manifest = {
+        'format': file_format,
+        'establishment_id': establishment_id,
+        'since': since.isoformat() if since else None,
+        'until': datetime.now().isoformat(),
+        'tables': {},
+    }
+    with tempfile.TemporaryDirectory() as folder, _snapshot_connection(db.engine) as connection:
+        files = []
+        for table in EXPORT_TABLES:
+            query = table.query(establishment_id)
+            incremental = since is not None and table.changed_at is not None
+            if incremental:
+                query = query.where(table.changed_at >= since)
+            file_name = f'{table.name}.{FILE_EXTENSIONS[file_format]}'
+            path = os.path.join(folder, file_name)
+            rows = _write_table(connection, query, path, file_format, chunk_size)
+            manifest['tables'][table.name] = {
+                'file': file_name,
+                'rows': rows,
+                'incremental': incremental,
+                'columns': [column.name for column in query.selected_columns],
+            }
+            files.append((path, file_name))
+        # Файлы уже сжаты, архив только собирает их вместе
+        with zipfile.ZipFile(target, 'w', compression=zipfile.ZIP_STORED) as archive:
+            archive.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+            for path, file_name in files:
+                archive.write(path, file_name)
+    return manifest
+
+
+# Замер выгрузки rows строк инвентаризации из временной базы SQLite (рабочая база не затрагивается)
+def benchmark_export(rows=1000000, file_format=None, chunk_size=CHUNK_SIZE):
+    file_format = file_format or available_formats()[0]
+    table = InventorySnapshotLine.__table__
+    with tempfile.TemporaryDirectory() as folder:
+        engine = create_engine(f"sqlite:///{os.path.join(folder, 'benchmark.db')}")
+        table.create(engine)
+        with engine.begin() as connection:
+            for start in range(0, rows, chunk_size):
+                connection.execute(insert(table), [
+                    {
+                        'snapshot_id': number // 500 + 1, 'establishment_id': 1, 'taken_on': datetime(2024, 1, 1).date(),
+                        'product_id': number % 500, 'location_id': number % 20, 'product_name': f'Продукт {number % 500}',
+                        'location_name': f'Локация {number % 20}', 'measurement': 'кг', 'quantity': number * 0.5,
+                    }
+                    for number in range(start, min(start + chunk_size, rows))
+                ])
+        path = os.path.join(folder, f'inventory_snapshot_lines.{FILE_EXTENSIONS[file_format]}')
+        query = select(*table.columns).order_by(table.c.id)
+        rss_before = _peak_rss_kb()
+        started = time.perf_counter()
+        with _snapshot_connection(engine, copy=False) as connection:
+            written = _write_table(connection, query, path, file_format, chunk_size)
+        elapsed = time.perf_counter() - started
+        size = os.path.getsize(path)
+        engine.dispose()
+    return {
+        'format': file_format,
+        'rows': written,
+        'seconds': elapsed,
+        'rows_per_second': written / elapsed if elapsed else 0,
+        'bytes': size,
+        # Рост пиковой памяти процесса за время выгрузки; None там, где нет модуля resource
+        'peak_rss_growth_mb': (_peak_rss_kb() - rss_before) / 1024 if rss_before is not None else None,
+    }
+
+
+# Пиковая память процесса в КБ; модуль resource есть только в Unix
+def _peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
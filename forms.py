@@ -17,7 +17,8 @@ class RegistrationForm(FlaskForm):
         ('старший', 'Старший'),
     ], validators=[DataRequired()])
 
-    establishment = SelectField('Заведение', choices=[('1', 'Лукашевича'), ('2', 'Ленина')], validators=[DataRequired()])
+    # Варианты заполняются в представлении из таблицы заведений (tenancy.establishment_choices)
+    establishment = SelectField('Заведение', choices=[], coerce=int, validators=[DataRequired()])
     
     submit = SubmitField('Регистрация')
 
@@ -0,0 +1,206 @@
+from functools import wraps
+import gzip
+import hashlib
+import os
+import threading
+import brotli
+from flask import current_app, make_response, request
+from flask_login import current_user
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import Session
+from werkzeug.security import safe_join
+from models import db, TableVersion, insert_ignoring_duplicates
+
+# Статика со ссылкой через url_for('static', ...) получает параметр v с хэшем
+# содержимого файла и кэшируется браузером на год. Файл изменился — изменилась ссылка
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+COMPRESSIBLE = {'text/html', 'application/json', 'text/css', 'text/javascript', 'application/javascript', 'image/svg+xml'}
+MIN_COMPRESS_SIZE = 500
+
+# Динамические ответы сжимаются быстро, статика — максимально и один раз
+COMPRESSORS = {
+    'br': lambda data, static: brotli.compress(data, quality=11 if static else 5),
+    'gzip': lambda data, static: gzip.compress(data, compresslevel=9 if static else 6),
+}
+
+_fingerprints = {}
+_compressed_static = {}
+_static_lock = threading.Lock()
+
+
+def _file_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def static_fingerprint(filename):
+    path = safe_join(current_app.static_folder, filename)
+    key = path and _file_key(path)
+    if key is None:
+        return None
+    fingerprint = _fingerprints.get(key)
+    if fingerprint is None:
+        with open(path, 'rb') as file:
+            fingerprint = hashlib.md5(file.read()).hexdigest()[:12]
+        _fingerprints[key] = fingerprint
+    return fingerprint
+
+
+# app.url_defaults: добавляет отпечаток ко всем ссылкам на статику
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and isinstance(values.get('filename'), str) and 'v' not in values:
+        fingerprint = static_fingerprint(values['filename'])
+        if fingerprint:
+            values['v'] = fingerprint
+
+
+def _compress_static_file(path, encoding):
+    key = _file_key(path)
+    with _static_lock:
+        cached = _compressed_static.get((key, encoding))
+    if cached is None:
+        with open(path, 'rb') as file:
+            cached = COMPRESSORS[encoding](file.read(), True)
+        with _static_lock:
+            _compressed_static[(key, encoding)] = cached
+    return cached
+
+
+# app.after_request: долгий кэш для статики с отпечатком и сжатие brotli/gzip
+# HTML, JSON и текстовой статики
+def optimise_response(response):
+    if request.endpoint == 'static' and response.status_code in (200, 304) and request.args.get('v'):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+
+    if response.status_code != 200 or response.mimetype not in COMPRESSIBLE or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(list(COMPRESSORS))
+    if encoding is None:
+        return response
+
+    if request.endpoint == 'static':
+        path = safe_join(current_app.static_folder, request.view_args['filename'])
+        if response.content_length is not None and response.content_length < MIN_COMPRESS_SIZE:
+            return response
+        data = _compress_static_file(path, encoding)
+        response.direct_passthrough = False
+    else:
+        if response.is_streamed:
+            return response
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return response
+        data = COMPRESSORS[encoding](data, False)
+
+    # Тело send_file — открытый файл; set_data его не закрывает
+    response.close()
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # Сжатое представление не совпадает побайтно с исходным
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# Версии таблиц. Изменённые таблицы собираются из unit of work (after_flush) и из
+# массовых INSERT/UPDATE/DELETE (do_orm_execute); счётчики увеличиваются в той же
+# транзакции, поэтому откат записи откатывает и версию
+def _bump(session, table_names):
+    table_names = set(table_names) - {TableVersion.__tablename__}
+    if table_names:
+        session.connection().execute(
+            update(TableVersion.__table__)
+            .where(TableVersion.__table__.c.table_name.in_(table_names))
+            .values(version=TableVersion.__table__.c.version + 1)
+        )
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_flushed_tables(session, flush_context):
+    changed = {instance.__table__.name for instance in session.new}
+    changed.update(instance.__table__.name for instance in session.deleted)
+    changed.update(instance.__table__.name for instance in session.dirty if session.is_modified(instance))
+    _bump(session, changed)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_bulk_tables(execute_state):
+    if execute_state.is_insert or execute_state.is_update or execute_state.is_delete:
+        table = getattr(execute_state.statement, 'table', None)
+        if table is not None:
+            execute_state.session.info.setdefault('changed_tables', set()).add(table.name)
+
+
+@event.listens_for(Session, 'before_commit')
+def _bump_bulk_tables(session):
+    _bump(session, session.info.pop('changed_tables', ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_bulk_tables(session):
+    session.info.pop('changed_tables', None)
+
+
+# Вызывается при старте приложения: строка-счётчик для каждой таблицы
+def seed_table_versions():
+    db.session.execute(
+        insert_ignoring_duplicates(TableVersion),
+        [{'table_name': name, 'version': 0} for name in db.metadata.tables],
+    )
+    db.session.commit()
+
+
+def table_versions(table_names):
+    return dict(db.session.execute(
+        select(TableVersion.table_name, TableVersion.version).where(TableVersion.table_name.in_(table_names))
+    ).all())
+
+
+# Слабый ETag страницы-списка: зависит от версий таблиц, пользователя (шапка страницы)
+# и шаблонов. Если ничего не изменилось, страница не строится заново — ответ 304
+def conditional_on(*table_names):
+    table_names = set(table_names) | {'users', 'establishments'}
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+            versions = table_versions(table_names)
+            key = repr((request.endpoint, current_user.get_id(), _templates_version(), sorted(versions.items())))
+            etag = hashlib.md5(key.encode('utf-8')).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+_templates_versions = {}
+
+
+# После выкладки новых шаблонов старые ETag перестают совпадать
+def _templates_version():
+    folder = os.path.join(current_app.root_path, current_app.template_folder)
+    if folder not in _templates_versions:
+        _templates_versions[folder] = max(
+            (os.stat(os.path.join(root, name)).st_mtime_ns for root, _, names in os.walk(folder) for name in names),
+            default=0,
+        )
+    return _templates_versions[folder]
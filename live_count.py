@@ -0,0 +1,237 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import queue
+import threading
+from sqlalchemy import select, update
+from models import db, CountSession, CountSessionLine, Location, Measurement, Product, insert_or_update
+
+
+class LiveCount:
+    def __init__(self, session_id, quantities):
+        self.session_id = session_id
+        self.quantities = quantities  # {product_id: количество}
+        self.pending = {}  # {product_id: (количество, user_id, время)} — ещё не записано в базу
+        self.subscribers = set()
+        self.seq = 0
+
+
+def _message(event, seq, data):
+    return f'id: {seq}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+# Общая инвентаризация заведения в памяти процесса. Повара присылают количества через
+# push(), все открытые страницы получают изменения через SSE (open_stream). В базу
+# изменения пишет фоновый поток пакетами: раз в flush_interval секунд или сразу, когда
+# накопилось flush_size строк. Повторные изменения одного продукта между записями
+# схлопываются в одно. Медленный клиент, чья очередь переполнилась, получает
+# полное состояние вместо пропущенных событий.
+# Каждый открытый поток SSE занимает обработчик запросов (поток или синхронный воркер)
+# на всё время подключения, поэтому одновременно открыто не больше max_streams потоков;
+# лишние подключения получают busy и переподключаются через busy_retry секунд
+class LiveCountHub:
+    def __init__(self, app, flush_interval=1.0, flush_size=200, queue_size=100, keepalive=15.0, max_streams=20, busy_retry=30.0):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self.max_streams = max_streams
+        self.busy_retry = busy_retry
+        self._counts = {}
+        self._streams = 0
+        self._lock = threading.Lock()
+        self._loading = {}  # {establishment_id: Lock} — загрузка сессии из базы
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='live-count-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.app.logger.exception('Ошибка записи общей инвентаризации: %s', e)
+
+    # Открытая сессия заведения загружается из базы один раз. Запросы к базе идут вне
+    # self._lock, под блокировкой своего заведения: медленная загрузка одного заведения
+    # не задерживает остальных, а два запроса не создадут две сессии
+    def _count(self, establishment_id, create=True):
+        with self._lock:
+            count = self._counts.get(establishment_id)
+            if count is not None:
+                return count
+            loading = self._loading.setdefault(establishment_id, threading.Lock())
+        with loading:
+            with self._lock:
+                count = self._counts.get(establishment_id)
+            if count is None:
+                count = self._load(establishment_id, create)
+                if count is not None:
+                    with self._lock:
+                        self._counts[establishment_id] = count
+        return count
+
+    # Сессия заведения под self._lock. Если её закрыли между загрузкой и захватом
+    # блокировки, берётся заново
+    @contextmanager
+    def _locked_count(self, establishment_id, create=True):
+        while True:
+            count = self._count(establishment_id, create)
+            with self._lock:
+                if count is None or self._counts.get(establishment_id) is count:
+                    yield count
+                    return
+
+    def _load(self, establishment_id, create):
+        session = db.session.scalars(
+            select(CountSession)
+            .where(CountSession.establishment_id == establishment_id, CountSession.status == 'open')
+            .order_by(CountSession.id.desc())
+            .execution_options(skip_tenant_scope=True)
+        ).first()
+        if session is None:
+            if not create:
+                return None
+            session = CountSession(establishment_id=establishment_id)
+            db.session.add(session)
+            db.session.commit()
+        quantities = dict(db.session.execute(
+            select(CountSessionLine.product_id, CountSessionLine.quantity).where(CountSessionLine.session_id == session.id)
+        ).all())
+        return LiveCount(session.id, quantities)
+
+    def _snapshot(self, count):
+        return _message('snapshot', count.seq, {'quantities': count.quantities, 'participants': len(count.subscribers)})
+
+    def _broadcast(self, count, message):
+        for subscriber in list(count.subscribers):
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait(self._snapshot(count))
+
+    # quantities — {product_id: количество или None, если поле очищено}
+    def push(self, establishment_id, user_id, username, quantities):
+        now = datetime.now()
+        with self._locked_count(establishment_id) as count:
+            for product_id, quantity in quantities.items():
+                count.quantities[product_id] = quantity
+                count.pending[product_id] = (quantity, user_id, now)
+            count.seq += 1
+            self._broadcast(count, _message('update', count.seq, {
+                'quantities': quantities, 'user': username, 'participants': len(count.subscribers),
+            }))
+            backlog = len(count.pending)
+        self._start()
+        if backlog >= self.flush_size:
+            self._wakeup.set()
+        return count.seq
+
+    def _write(self, batches):
+        rows = [
+            {'session_id': count.session_id, 'product_id': product_id, 'quantity': quantity, 'user_id': user_id, 'updated_at': updated_at}
+            for count, pending in batches
+            for product_id, (quantity, user_id, updated_at) in pending.items()
+        ]
+        if rows:
+            db.session.execute(
+                insert_or_update(CountSessionLine, ['session_id', 'product_id'], ['quantity', 'user_id', 'updated_at']),
+                rows,
+            )
+        return len(rows)
+
+    def flush(self):
+        with self._lock:
+            batches = [(count, count.pending) for count in self._counts.values() if count.pending]
+            for count, _ in batches:
+                count.pending = {}
+        if not batches:
+            return 0
+        try:
+            with self.app.app_context():
+                written = self._write(batches)
+                db.session.commit()
+        except Exception:
+            # Возвращаем строки в очередь, не затирая более свежие изменения
+            with self._lock:
+                for count, pending in batches:
+                    for product_id, change in pending.items():
+                        count.pending.setdefault(product_id, change)
+            raise
+        return written
+
+    # Подписка на изменения: сначала полное состояние, затем события update.
+    # Подписка оформляется сразу, сам поток читается уже вне контекста запроса
+    def open_stream(self, establishment_id):
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self._locked_count(establishment_id) as count:
+            if self._streams >= self.max_streams:
+                return iter([f'retry: {int(self.busy_retry * 1000)}\n' + _message('busy', count.seq, {})])
+            self._streams += 1
+            count.subscribers.add(subscriber)
+            snapshot = self._snapshot(count)
+
+        def events():
+            try:
+                yield snapshot
+                while True:
+                    try:
+                        message = subscriber.get(timeout=self.keepalive)
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                    yield message
+                    if '\nevent: closed\n' in message:
+                        return
+            finally:
+                with self._lock:
+                    count.subscribers.discard(subscriber)
+                    self._streams -= 1
+
+        return events()
+
+    # Завершает общую инвентаризацию: дописывает несохранённое, закрывает сессию
+    # и возвращает итоговые количества {product_id: количество}
+    def close(self, establishment_id):
+        with self._locked_count(establishment_id, create=False) as count:
+            if count is None:
+                return {}
+            self._counts.pop(establishment_id)
+            pending, count.pending = count.pending, {}
+            count.seq += 1
+            self._broadcast(count, _message('closed', count.seq, {}))
+        self._write([(count, pending)])
+        db.session.execute(
+            update(CountSession).where(CountSession.id == count.session_id)
+            .values(status='closed', closed_at=datetime.now())
+        )
+        db.session.commit()
+        return {product_id: quantity for product_id, quantity in count.quantities.items() if quantity is not None}
+
+
+# Строки для снимка инвентаризации (reports.record_snapshot) по итоговым количествам
+def count_lines(quantities):
+    rows = db.session.execute(
+        select(Product.id, Product.name, Location.id, Location.name, Measurement.name)
+        .join(Location, Location.id == Product.location_id)
+        .join(Measurement, Measurement.id == Product.measurement_id)
+        .where(Product.id.in_(quantities))
+        .order_by(Location.name, Product.name)
+    ).all()
+    return [
+        {
+            'product_id': product_id, 'location_id': location_id, 'product_name': product_name,
+            'location_name': location_name, 'measurement': measurement, 'quantity': quantities[product_id],
+        }
+        for product_id, product_name, location_id, location_name, measurement in rows
+    ]
@@ -2,9 +2,16 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.schema import CreateTable
 
 db = SQLAlchemy()
 
+# Маркер для моделей, которые принадлежат конкретному заведению.
+# Запросы к таким моделям автоматически фильтруются по текущему заведению (см. tenancy.py)
+class TenantScoped:
+    pass
+
 class Establishment(db.Model):
     __tablename__ = 'establishments'  # таблица для заведений
     id = db.Column(db.Integer, primary_key=True)
@@ -18,7 +25,7 @@ class Establishment(db.Model):
     # Связь с продуктами
     products = db.relationship('Product', backref='establishment', lazy=True)
 
-class User(db.Model, UserMixin):
+class User(db.Model, UserMixin, TenantScoped):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -26,7 +33,7 @@ class User(db.Model, UserMixin):
     role = db.Column(db.String(50), nullable=False, default='user')
     
     # Внешний ключ для связи с заведением
-    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False, index=True)
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -34,21 +41,22 @@ class User(db.Model, UserMixin):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-class Product(db.Model):
+class Product(db.Model, TenantScoped):
     __tablename__ = 'products'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
     
     location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False)
     measurement_id = db.Column(db.Integer, db.ForeignKey('measurement.id'), nullable=False)
+    # Устаревшее поле: связи с поставщиками хранятся в supplier_product (см. supplier_catalogue.py)
     supplier_id = db.Column(db.Integer, db.ForeignKey('suppliers.id'), nullable=True)
 
     # Внешний ключ для связи с заведением
-    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False, index=True)
 
     location = db.relationship('Location', backref=db.backref('products', lazy=True))
     measurement = db.relationship('Measurement', backref=db.backref('products', lazy=True))
-    supplier = db.relationship('Supplier', back_populates='products')
+    supplier = db.relationship('Supplier', foreign_keys=[supplier_id])
     dish_products = db.relationship('DishProduct', back_populates='product')
     
 
@@ -59,33 +67,46 @@ class Measurement(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20), nullable=False, unique=True)
 
-class Location(db.Model):
+class Location(db.Model, TenantScoped):
     __tablename__ = 'location'  # таблица для местоположений
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=False, nullable=False)
-    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False, index=True)
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
 
-class Supplier(db.Model):
+class Supplier(db.Model, TenantScoped):
     __tablename__ = 'suppliers'  # таблица для поставщиков
+    # Название уникально в пределах заведения (см. _drop_legacy_supplier_name_unique)
+    __table_args__ = (db.Index('ux_suppliers_establishment_name', 'establishment_id', 'name', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(80), unique=True, nullable=False)
+    name = db.Column(db.String(80), nullable=False)
+
+    # Заведение поставщика; NULL — поставщик общий для всех заведений
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=True, index=True)
+
+    # Адрес для автоматической отправки заявок (см. dispatch.py)
+    email = db.Column(db.String(120), nullable=True)
     
-    # Связь с продуктами
-    products = db.relationship('Product', back_populates='supplier')
+    # Связь с продуктами только для чтения; изменения идут через supplier_catalogue.py
+    products = db.relationship('Product', secondary='supplier_product', viewonly=True, order_by='Product.name')
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
 
-# Обратите внимание на названия таблиц в связывающей таблице
-supplier_product = db.Table('supplier_product',
-    db.Column('supplier_id', db.Integer, db.ForeignKey('suppliers.id'), primary_key=True),  # исправлено на 'suppliers.id'
-    db.Column('product_id', db.Integer, db.ForeignKey('products.id'), primary_key=True)  # исправлено на 'products.id'
-)
+# Каталог поставщика: продукт, его цена и фасовка у конкретного поставщика
+class SupplierProduct(db.Model):
+    __tablename__ = 'supplier_product'
+    supplier_id = db.Column(db.Integer, db.ForeignKey('suppliers.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True, index=True)
+    price = db.Column(db.Float, nullable=True)
+    pack_size = db.Column(db.Float, nullable=True)
+
+    supplier = db.relationship('Supplier')
+    product = db.relationship('Product')
 
 class DishProduct(db.Model):
     __tablename__ = 'dish_products'
@@ -97,21 +118,62 @@ class DishProduct(db.Model):
     dish = db.relationship('Dish', back_populates='dish_products')
     product = db.relationship('Product', back_populates='dish_products')
 
-class Dish(db.Model):
+# Блюдо как ингредиент другого блюда (соус, тесто): quantity — сколько порций
+# полуфабриката идёт на одну порцию блюда
+class DishComponent(db.Model):
+    __tablename__ = 'dish_components'
+    dish_id = db.Column(db.Integer, db.ForeignKey('dishes.id'), primary_key=True)
+    component_id = db.Column(db.Integer, db.ForeignKey('dishes.id'), primary_key=True, index=True)
+    quantity = db.Column(db.Float, nullable=False)
+
+    dish = db.relationship('Dish', foreign_keys=[dish_id], back_populates='components')
+    component = db.relationship('Dish', foreign_keys=[component_id])
+
+class Dish(db.Model, TenantScoped):
     __tablename__ = 'dishes'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
     image_url = db.Column(db.String(200), nullable=True)  
     preparation_steps = db.Column(db.Text, nullable=True)  
+    # Очищенный HTML и список шагов, подготовленные при сохранении (см. preparation.py)
+    preparation_html = db.Column(db.Text, nullable=True)
+    preparation_step_list = db.Column(db.JSON, nullable=True)
     video_url = db.Column(db.String(200), nullable=True)  
+
+    # Заведение блюда; NULL — блюдо общее для всех заведений
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=True, index=True)
     
     # Связь с DishProduct
     dish_products = db.relationship('DishProduct', back_populates='dish')
+    # Полуфабрикаты (другие блюда), входящие в рецепт
+    components = db.relationship('DishComponent', foreign_keys='DishComponent.dish_id', back_populates='dish')
 
 
 
     
 
+# Счётчик изменений таблицы: растёт в той же транзакции, что и запись в таблицу.
+# По нему строятся ETag страниц-списков (см. http_cache.py)
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+# Журнал изменений (только добавление записей). Пишется фоновым потоком из audit.py
+class AuditEntry(db.Model, TenantScoped):
+    __tablename__ = 'audit_log'
+    __table_args__ = (db.Index('ix_audit_log_table_row', 'table_name', 'row_id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=True, index=True)
+    user_id = db.Column(db.Integer, nullable=True, index=True)  # без внешнего ключа: запись переживает пользователя
+    username = db.Column(db.String(80), nullable=True)
+    action = db.Column(db.String(20), nullable=False)  # insert, update, delete, bulk_insert, bulk_update, bulk_delete
+    table_name = db.Column(db.String(64), nullable=False)
+    row_id = db.Column(db.String(64), nullable=True)
+    changes = db.Column(db.JSON, nullable=True)
+    endpoint = db.Column(db.String(80), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)
+
 # Добавляем захардкоженные единицы измерения при первом запуске
 def add_default_measurements():
     if Measurement.query.count() == 0:
@@ -120,10 +182,94 @@ def add_default_measurements():
             db.session.add(Measurement(name=measurement))
         db.session.commit()
 
+# Заведения, которые раньше были захардкожены в forms.py и decorators.py
+def add_default_establishments():
+    if Establishment.query.count() == 0:
+        for establishment_id, name in ((1, 'Лукашевича'), (2, 'Ленина')):
+            db.session.add(Establishment(id=establishment_id, name=name))
+        db.session.commit()
+
+# INSERT, который пропускает строки с уже существующим ключом
+def insert_ignoring_duplicates(table):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return sqlite.insert(table).on_conflict_do_nothing()
+
+# INSERT, который при совпадении ключа index_elements перезаписывает колонки columns
+def insert_or_update(table, index_elements, columns):
+    statement = (postgresql if db.session.get_bind().dialect.name == 'postgresql' else sqlite).insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={column: statement.excluded[column] for column in columns},
+    )
+
+# db.create_all() не меняет уже существующие таблицы, поэтому
+# недостающие колонки и индексы добавляем вручную
+def upgrade_schema():
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=connection.dialect)
+                    connection.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.unique and index.name not in existing_indexes:
+                    _delete_duplicates(connection, table, index)
+                index.create(connection, checkfirst=True)
+        _drop_legacy_supplier_name_unique(connection, inspector)
+
+# Перед созданием нового уникального индекса удаляются строки-дубликаты
+# (остаётся строка с наименьшим id), иначе индекс на старых данных не создастся
+def _delete_duplicates(connection, table, index):
+    if 'id' not in table.c:
+        return
+    columns = [table.c[column.name] for column in index.columns]
+    keep = db.select(db.func.min(table.c.id)).group_by(*columns)
+    # Строки с NULL в ключе уникальный индекс не ограничивает
+    connection.execute(db.delete(table).where(table.c.id.not_in(keep), *(column.is_not(None) for column in columns)))
+
+# Раньше название поставщика было уникальным во всей базе. В PostgreSQL ограничение
+# просто удаляется; в SQLite ограничение колонки удалить нельзя, поэтому таблица
+# пересоздаётся по текущей модели с копированием строк и индексов
+def _drop_legacy_supplier_name_unique(connection, inspector):
+    if not inspector.has_table('suppliers'):
+        return
+    if connection.dialect.name == 'postgresql':
+        for constraint in inspector.get_unique_constraints('suppliers'):
+            if constraint['column_names'] == ['name']:
+                connection.execute(db.text(f'ALTER TABLE suppliers DROP CONSTRAINT {constraint["name"]}'))
+        return
+    if connection.dialect.name != 'sqlite':
+        return
+    legacy = any(
+        unique and origin == 'u'
+        and [info[2] for info in connection.exec_driver_sql(f"PRAGMA index_info('{index_name}')")] == ['name']
+        for _, index_name, unique, origin, *_ in connection.exec_driver_sql("PRAGMA index_list('suppliers')").all()
+    )
+    if not legacy:
+        return
+    table = Supplier.__table__
+    # Недостающие колонки к этому моменту уже добавлены в upgrade_schema
+    columns = ', '.join(column.name for column in table.columns)
+    create = str(CreateTable(table).compile(dialect=connection.dialect))
+    connection.exec_driver_sql(create.replace('CREATE TABLE suppliers', 'CREATE TABLE suppliers_rebuilt', 1))
+    connection.exec_driver_sql(f'INSERT INTO suppliers_rebuilt ({columns}) SELECT {columns} FROM suppliers')
+    connection.exec_driver_sql('DROP TABLE suppliers')
+    connection.exec_driver_sql('ALTER TABLE suppliers_rebuilt RENAME TO suppliers')
+    for index in table.indexes:
+        index.create(connection)
+
 
 
 class UserProductLocation(db.Model):
     __tablename__ = 'user_product_location'
+    # Одна локация назначается пользователю не более одного раза (см. assignments.py)
+    __table_args__ = (db.Index('ux_user_product_location', 'user_id', 'location_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     
     # Внешний ключ для пользователя
@@ -134,6 +280,101 @@ class UserProductLocation(db.Model):
     location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False)
     location = db.relationship('Location', backref=db.backref('assigned_users', lazy=True))
 
+# Сохранённая инвентаризация: одна запись на каждую отправку формы /inventory
+class InventorySnapshot(db.Model, TenantScoped):
+    __tablename__ = 'inventory_snapshots'
+    id = db.Column(db.Integer, primary_key=True)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    number = db.Column(db.Integer, nullable=True)  # номер из имени XLSX-файла
+    taken_on = db.Column(db.Date, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    user = db.relationship('User')
+
+# Строки инвентаризации в «длинном» формате: одна строка — один продукт.
+# Названия копируются, чтобы отчёты не зависели от последующих переименований и удалений
+class InventorySnapshotLine(db.Model, TenantScoped):
+    __tablename__ = 'inventory_snapshot_lines'
+    __table_args__ = (
+        db.Index('ix_snapshot_lines_establishment_date_product', 'establishment_id', 'taken_on', 'product_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    snapshot_id = db.Column(db.Integer, db.ForeignKey('inventory_snapshots.id'), nullable=False, index=True)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False)
+    taken_on = db.Column(db.Date, nullable=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    location_id = db.Column(db.Integer, nullable=True)
+    product_name = db.Column(db.String(80), nullable=False)
+    location_name = db.Column(db.String(80), nullable=True)
+    measurement = db.Column(db.String(20), nullable=True)
+    quantity = db.Column(db.Float, nullable=False)
 
+# Общая инвентаризация заведения, которую несколько поваров ведут одновременно
+# (см. live_count.py). Открытая сессия у заведения одна
+class CountSession(db.Model, TenantScoped):
+    __tablename__ = 'count_sessions'
+    id = db.Column(db.Integer, primary_key=True)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='open')  # open, closed
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    closed_at = db.Column(db.DateTime, nullable=True)
+
+# Текущее количество продукта в общей инвентаризации; NULL — поле очищено
+class CountSessionLine(db.Model):
+    __tablename__ = 'count_session_lines'
+    session_id = db.Column(db.Integer, db.ForeignKey('count_sessions.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    quantity = db.Column(db.Float, nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+# Исходящие заявки поставщикам (transactional outbox): запись создаётся в той же транзакции,
+# что и заявка, а рендеринг файла и доставку выполняет фоновый обработчик из dispatch.py
+class OrderOutbox(db.Model, TenantScoped):
+    __tablename__ = 'order_outbox'
+    __table_args__ = (
+        db.Index('ix_order_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=False, index=True)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('suppliers.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, rendered, failed
+    file_format = db.Column(db.String(10), nullable=False, default='xlsx')
+    payload = db.Column(db.JSON, nullable=False)
+    file_name = db.Column(db.String(200), nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    last_error = db.Column(db.Text, nullable=True)
+    # Метка обработчика, взявшего заявку, и срок, после которого её может забрать другой
+    claim_token = db.Column(db.String(32), nullable=True)
+    claimed_until = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    supplier = db.relationship('Supplier')
+
+# Цена единицы продукта (в его единице измерения) у поставщика, действующая с effective_from
+class ProductPrice(db.Model):
+    __tablename__ = 'product_prices'
+    __table_args__ = (
+        db.Index('ix_product_prices_product_supplier_date', 'product_id', 'supplier_id', 'effective_from'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('suppliers.id'), nullable=True)
+    unit_price = db.Column(db.Float, nullable=False)
+    effective_from = db.Column(db.Date, nullable=False)
 
-
+# Предрассчитанная себестоимость блюда (см. costing.py).
+# valid_until — дата ближайшего будущего изменения цены одного из продуктов блюда
+class DishCost(db.Model, TenantScoped):
+    __tablename__ = 'dish_costs'
+    dish_id = db.Column(db.Integer, db.ForeignKey('dishes.id'), primary_key=True)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishments.id'), nullable=True, index=True)
+    cost = db.Column(db.Float, nullable=False, default=0.0)
+    priced_lines = db.Column(db.Integer, nullable=False, default=0)
+    missing_lines = db.Column(db.Integer, nullable=False, default=0)
+    valid_until = db.Column(db.Date, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
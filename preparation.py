@@ -0,0 +1,82 @@
+from bs4 import BeautifulSoup, Comment
+from sqlalchemy import select, update
+from models import db, Dish
+
+# Теги, которые может выдать редактор TinyMCE на странице добавления блюда.
+# Остальные теги снимаются с сохранением текста, DROPPED_TAGS — вместе с содержимым
+ALLOWED_TAGS = {'p', 'br', 'strong', 'b', 'em', 'i', 'u', 'span', 'ul', 'ol', 'li', 'a', 'img'}
+ALLOWED_ATTRIBUTES = {'a': {'href', 'title'}, 'img': {'src', 'alt', 'width', 'height'}}
+URL_ATTRIBUTES = {'href', 'src'}
+SAFE_SCHEMES = {'http', 'https', 'mailto'}
+DROPPED_TAGS = {'script', 'style', 'iframe', 'object', 'embed', 'form', 'input', 'button', 'textarea', 'select', 'template'}
+
+
+def _safe_url(url):
+    url = url.strip()
+    scheme, separator, _ = url.partition(':')
+    # Относительные ссылки разрешены; двоеточие после /, ? или # — уже не схема
+    if not separator or any(char in scheme for char in '/?#'):
+        return True
+    return scheme.strip().lower() in SAFE_SCHEMES
+
+
+# Очищает HTML технологии приготовления и разбирает его на шаги.
+# Возвращает (очищенный HTML, [текст шага, ...]). Шаги — пункты списков,
+# если списков нет — абзацы
+def parse_preparation(html):
+    soup = BeautifulSoup(html or '', 'html.parser')
+    for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
+        comment.extract()
+    for tag in soup.find_all(True):
+        if tag.decomposed:
+            continue
+        if tag.name in DROPPED_TAGS:
+            tag.decompose()
+        elif tag.name not in ALLOWED_TAGS:
+            tag.unwrap()
+        else:
+            allowed = ALLOWED_ATTRIBUTES.get(tag.name, set())
+            tag.attrs = {
+                name: value for name, value in tag.attrs.items()
+                if name in allowed and (name not in URL_ATTRIBUTES or _safe_url(value))
+            }
+            if tag.name == 'a' and 'href' in tag.attrs:
+                tag.attrs['rel'] = 'noopener noreferrer'
+
+    steps = [item.get_text(' ', strip=True) for item in soup.find_all('li')]
+    if not steps:
+        steps = [paragraph.get_text(' ', strip=True) for paragraph in soup.find_all('p')]
+    return str(soup).strip(), [step for step in steps if step]
+
+
+# Сохраняет исходный HTML вместе с очищенной версией и списком шагов
+def apply_preparation(dish, html):
+    dish.preparation_steps = html
+    dish.preparation_html, dish.preparation_step_list = parse_preparation(html)
+
+
+# Заполняет очищенный HTML и шаги для блюд, сохранённых до их появления.
+# force=True пересчитывает все блюда (например, после изменения ALLOWED_TAGS)
+def backfill_preparation(batch_size=500, force=False):
+    converted, last_id = 0, 0
+    while True:
+        query = (
+            select(Dish.id, Dish.preparation_steps)
+            .where(Dish.id > last_id, Dish.preparation_steps.is_not(None))
+            .order_by(Dish.id)
+            .limit(batch_size)
+            .execution_options(skip_tenant_scope=True)
+        )
+        if not force:
+            query = query.where(Dish.preparation_html.is_(None))
+        rows = db.session.execute(query).all()
+        if not rows:
+            return converted
+        values = []
+        for dish_id, html in rows:
+            clean_html, steps = parse_preparation(html)
+            values.append({'id': dish_id, 'preparation_html': clean_html, 'preparation_step_list': steps})
+        db.session.execute(update(Dish), values)
+        db.session.commit()
+        converted += len(rows)
+        last_id = rows[-1].id
@@ -0,0 +1,91 @@
+from datetime import date
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from sqlalchemy import insert, select
+from models import db, InventorySnapshot, InventorySnapshotLine
+from tenancy import current_establishment_id
+
+LINE_KEY = ['product_id', 'product_name', 'location_name', 'measurement']
+REPORT_CACHE_SIZE = 64
+
+
+# Сохраняет инвентаризацию одним INSERT ... VALUES на все строки.
+# lines — словари с ключами product_id, location_id, product_name, location_name, measurement, quantity
+def record_snapshot(lines, user_id=None, number=None, establishment_id=None, taken_on=None):
+    establishment_id = establishment_id or current_establishment_id()
+    taken_on = taken_on or date.today()
+    snapshot = InventorySnapshot(establishment_id=establishment_id, user_id=user_id, number=number, taken_on=taken_on)
+    db.session.add(snapshot)
+    db.session.flush()
+    if lines:
+        db.session.execute(insert(InventorySnapshotLine), [
+            dict(line, snapshot_id=snapshot.id, establishment_id=establishment_id, taken_on=taken_on)
+            for line in lines
+        ])
+    db.session.commit()
+    return snapshot.id
+
+
+def snapshot_list(limit=100):
+    return db.session.execute(
+        select(InventorySnapshot.id, InventorySnapshot.number, InventorySnapshot.taken_on, InventorySnapshot.created_at)
+        .order_by(InventorySnapshot.created_at.desc(), InventorySnapshot.id.desc())
+        .limit(limit)
+    ).all()
+
+
+# Все строки нужных инвентаризаций одним запросом
+def _snapshot_frame(snapshot_ids):
+    rows = db.session.execute(
+        select(InventorySnapshotLine.snapshot_id, *(getattr(InventorySnapshotLine, column) for column in LINE_KEY), InventorySnapshotLine.quantity)
+        .where(InventorySnapshotLine.snapshot_id.in_(snapshot_ids))
+    ).all()
+    frame = pd.DataFrame.from_records(rows, columns=['snapshot_id', *LINE_KEY, 'quantity'])
+    frame[['location_name', 'measurement']] = frame[['location_name', 'measurement']].fillna('')
+    return frame
+
+
+def _records(frame):
+    return frame.replace({np.nan: None}).to_dict('records')
+
+
+def _compare(base_id, current_id, top):
+    frame = _snapshot_frame([base_id, current_id])
+    comparison = (
+        frame.groupby(LINE_KEY + ['snapshot_id'])['quantity'].sum()
+        .unstack('snapshot_id')
+        .reindex(columns=[base_id, current_id])
+        .fillna(0.0)
+        .set_axis(['base', 'current'], axis=1)
+        .reset_index()
+    )
+    comparison['delta'] = comparison['current'] - comparison['base']
+    comparison['change_pct'] = comparison['delta'] / comparison['base'].replace(0.0, np.nan) * 100
+    comparison = comparison.sort_values(['location_name', 'product_name'], kind='stable')
+
+    top_movers = comparison.loc[comparison['delta'].abs().nlargest(top).index]
+    top_movers = top_movers[top_movers['delta'] != 0]
+    locations = comparison.groupby('location_name', sort=True)[['base', 'current', 'delta']].sum().reset_index()
+    totals = comparison[['base', 'current', 'delta']].sum()
+
+    return {
+        'lines': _records(comparison),
+        'top_movers': _records(top_movers),
+        'locations': _records(locations),
+        'totals': {column: float(value) for column, value in totals.items()},
+    }
+
+
+# Сравнение двух инвентаризаций: разница по каждому продукту, самые большие изменения
+# и итоги по локациям. Инвентаризации не меняются после сохранения, поэтому результат
+# для пары кэшируется; хранятся только REPORT_CACHE_SIZE последних сравнений
+def compare_snapshots(base_id, current_id, top=10, establishment_id=None):
+    establishment_id = establishment_id or current_establishment_id()
+    return _cached_compare(establishment_id, base_id, current_id, top)
+
+
+# establishment_id входит в ключ: у каждого заведения свои отчёты
+@lru_cache(maxsize=REPORT_CACHE_SIZE)
+def _cached_compare(establishment_id, base_id, current_id, top):
+    return _compare(base_id, current_id, top)
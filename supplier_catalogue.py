@@ -0,0 +1,110 @@
+from sqlalchemy import delete, func, select, update
+from models import db, insert_ignoring_duplicates, Product, SupplierProduct
+from costing import set_product_prices
+from tenancy import Choice
+
+
+# Переносит старые связи Product.supplier_id в supplier_product. Вызывается при каждом
+# запуске: когда старых связей не осталось, ничего не пишет (ни журнала, ни версий таблиц)
+def migrate_supplier_links():
+    legacy_links = select(Product.supplier_id, Product.id).where(Product.supplier_id.isnot(None))
+    if db.session.scalar(legacy_links.limit(1)) is None:
+        return
+    db.session.execute(
+        insert_ignoring_duplicates(SupplierProduct.__table__)
+        .from_select(['supplier_id', 'product_id'], legacy_links)
+    )
+    db.session.execute(
+        update(Product).where(Product.supplier_id.isnot(None)).values(supplier_id=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+# Каталог поставщика одним запросом: {product_id: (price, pack_size)}
+def supplier_links(supplier_id):
+    rows = db.session.execute(
+        select(SupplierProduct.product_id, SupplierProduct.price, SupplierProduct.pack_size)
+        .where(SupplierProduct.supplier_id == supplier_id)
+    )
+    return {product_id: (price, pack_size) for product_id, price, pack_size in rows}
+
+
+# Применяет изменения каталога как разность множеств:
+#   links   — {product_id: (price, pack_size)}, которые должны быть у поставщика;
+#   remove  — product_id, которые нужно убрать;
+#   replace — убрать все связи, которых нет в links.
+# Удаление, вставка и обновление выполняются пакетно, по одному запросу на каждое
+def sync_supplier_links(supplier_id, links=None, remove=(), replace=False):
+    links = dict(links or {})
+    remove = set(remove)
+
+    # Продукты чужого заведения отфильтровываются автоматически (см. tenancy.py)
+    requested = set(links) | remove
+    allowed = set(db.session.scalars(select(Product.id).where(Product.id.in_(requested)))) if requested else set()
+    links = {product_id: values for product_id, values in links.items() if product_id in allowed}
+
+    current = supplier_links(supplier_id)
+    to_delete = (set(current) - set(links)) if replace else (remove & allowed & set(current))
+    to_insert = set(links) - set(current)
+    to_update = {product_id for product_id in set(links) & set(current) if current[product_id] != tuple(links[product_id])}
+
+    def rows(product_ids):
+        return [
+            {'supplier_id': supplier_id, 'product_id': product_id, 'price': links[product_id][0], 'pack_size': links[product_id][1]}
+            for product_id in product_ids
+        ]
+
+    if to_delete:
+        db.session.execute(
+            delete(SupplierProduct)
+            .where(SupplierProduct.supplier_id == supplier_id, SupplierProduct.product_id.in_(to_delete))
+            .execution_options(synchronize_session=False)
+        )
+    if to_insert:
+        db.session.execute(insert_ignoring_duplicates(SupplierProduct.__table__), rows(to_insert))
+    if to_update:
+        # ORM bulk UPDATE по первичному ключу (supplier_id, product_id)
+        db.session.execute(update(SupplierProduct), rows(to_update))
+    db.session.commit()
+
+    # Новая цена упаковки становится ценой единицы продукта с сегодняшнего дня (см. costing.py)
+    set_product_prices([
+        {'product_id': product_id, 'supplier_id': supplier_id, 'unit_price': price / (pack_size or 1)}
+        for product_id, (price, pack_size) in links.items()
+        if product_id in to_insert | to_update and price is not None
+    ])
+    return {'added': len(to_insert), 'updated': len(to_update), 'removed': len(to_delete)}
+
+
+# Уникальные по названию продукты для выпадающих списков, без загрузки ORM-объектов
+def product_choices():
+    rows = db.session.execute(
+        select(func.min(Product.id), Product.name).group_by(Product.name).order_by(Product.name)
+    )
+    return [Choice(product_id, name) for product_id, name in rows]
+
+
+def remove_product_links(product_id):
+    db.session.execute(
+        delete(SupplierProduct).where(SupplierProduct.product_id == product_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+# Разбор JSON вида {"links": [{"product_id": 1, "price": 120.5, "pack_size": 5}], "remove": [3], "replace": false}
+def parse_catalogue_payload(payload):
+    if not isinstance(payload, dict):
+        raise TypeError('ожидается JSON-объект')
+    links = {
+        int(link['product_id']): (_optional_float(link.get('price')), _optional_float(link.get('pack_size')))
+        for link in payload.get('links', [])
+    }
+    remove = {int(product_id) for product_id in payload.get('remove', [])}
+    return links, remove, bool(payload.get('replace', False))
+
+
+def _optional_float(value):
+    if value is None or value == '':
+        return None
+    return float(value)
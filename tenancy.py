@@ -0,0 +1,93 @@
+from collections import namedtuple
+import threading
+from flask import g, has_app_context, request
+from flask_login import current_user
+from sqlalchemy import event, or_
+from sqlalchemy.orm import Session, with_loader_criteria
+from models import db, Establishment, Location, TenantScoped
+
+Choice = namedtuple('Choice', ['id', 'name'])
+
+
+# Кэш, разделённый по заведениям: каждое заведение хранит и сбрасывает только свои данные.
+# Ключ раздела None используется для общих данных (например, списка заведений)
+class TenantCache:
+    def __init__(self):
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def get_or_set(self, establishment_id, key, factory):
+        with self._lock:
+            partition = self._partitions.setdefault(establishment_id, {})
+            if key in partition:
+                return partition[key]
+        value = factory()
+        with self._lock:
+            self._partitions.setdefault(establishment_id, {})[key] = value
+        return value
+
+    def invalidate(self, establishment_id, key=None):
+        with self._lock:
+            if key is None:
+                self._partitions.pop(establishment_id, None)
+            else:
+                self._partitions.get(establishment_id, {}).pop(key, None)
+
+
+tenant_cache = TenantCache()
+
+
+def current_establishment_id():
+    if not has_app_context():
+        return None
+    return g.get('establishment_id')
+
+
+# Вызывается перед каждым запросом, чтобы заведение было известно и в маршрутах без @user_details.
+# Статике заведение не нужно: без этой проверки каждый файл стоил бы запроса пользователя к базе
+def bind_establishment():
+    if request.endpoint == 'static':
+        return
+    if current_user.is_authenticated:
+        g.establishment_id = current_user.establishment_id
+
+
+# Все SELECT-запросы (включая ленивую загрузку связей) к моделям TenantScoped
+# ограничиваются текущим заведением. Записи с NULL считаются общими для всех заведений.
+# Отключить фильтр для отдельного запроса: .execution_options(skip_tenant_scope=True)
+@event.listens_for(Session, 'do_orm_execute')
+def _scope_to_establishment(execute_state):
+    if not execute_state.is_select or execute_state.execution_options.get('skip_tenant_scope'):
+        return
+    establishment_id = current_establishment_id()
+    if establishment_id is None:
+        return
+    execute_state.statement = execute_state.statement.options(*(
+        with_loader_criteria(
+            model,
+            lambda cls: or_(cls.establishment_id == establishment_id, cls.establishment_id.is_(None)),
+            include_aliases=True,
+        )
+        for model in TenantScoped.__subclasses__()
+    ))
+
+
+def establishment_names():
+    return tenant_cache.get_or_set(None, 'establishment_names', lambda: {
+        establishment.id: establishment.name
+        for establishment in Establishment.query.order_by(Establishment.id)
+    })
+
+
+def establishment_choices():
+    return list(establishment_names().items())
+
+
+def location_choices(establishment_id=None):
+    establishment_id = establishment_id or current_establishment_id()
+    return tenant_cache.get_or_set(establishment_id, 'location_choices', lambda: [
+        Choice(location_id, name)
+        for location_id, name in db.session.query(Location.id, Location.name)
+        .filter(Location.establishment_id == establishment_id)
+        .order_by(Location.id)
+    ])